@@ -0,0 +1,768 @@
+"""
+Offline benchmark for the bot handlers.
+
+Runs the real handlers from main.py against in-process fakes of Telegram,
+Google Sheets, Firestore, FMCSA and the ZIP table, each with a configurable
+latency, and reports per-handler latency percentiles, backend calls per
+command and memory use.
+
+    python bench.py --rows 1000 10000 100000 --users 50 --rounds 5
+    python bench.py --rows 1000000 --users 200 --firestore
+    python bench.py --webhook --rows 10000 --users 50
+
+--webhook runs the real Application (build_application) behind PTB's webhook
+server and posts synthetic Update JSON to it, measuring the time from POST to
+the end of handler processing; only the Bot API itself is faked.
+
+Nothing here talks to the network; BOT_TOKEN and SERVICE_ACCOUNT_JSON are not
+needed.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault("SERVICE_ACCOUNT_JSON", "{}")
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OUTBOX_PATH", os.path.join(tempfile.mkdtemp(prefix="rateguard-bench-"), "outbox.sqlite3"))
+
+import gspread  # noqa: E402
+import httpx  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+import main  # noqa: E402
+
+HEADER = ["Date", "Pickup ZIP", "Delivery ZIP", "Pickup", "Delivery", "Total Miles", "Rate", "RPM Loaded",
+          "RPM Total", "Trailer", "User", "Broker", "Comment", "Posted By", "User ID", "Load ID"]
+TRAILERS = ["Dry Van", "Reefer", "Flatbed", "Power Only", "Step Deck", "Conestoga", "Other"]
+BROKERS = ["123456", "234567", "345678", "456789", "999999"]
+
+calls = Counter()  # (backend, operation) -> count
+_calls_lock = threading.Lock()
+
+
+def count(backend, operation, n=1):
+    with _calls_lock:
+        calls[(backend, operation)] += n
+
+
+# === Fakes ===
+
+class FakeSpreadsheet:
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    def get_lastUpdateTime(self):
+        count("sheets", "lastUpdateTime")
+        time.sleep(self.sheet.latency)
+        return self.sheet.modified
+
+
+class FakeSheet:
+    """A worksheet whose first `base_rows` data rows are generated on demand."""
+
+    def __init__(self, base_rows, users, latency, seed=1):
+        self.latency = latency
+        self.users = users
+        self.seed = seed
+        self.header = list(HEADER)
+        self.base_rows = base_rows
+        self.extra = []    # appended rows
+        self.edits = {}    # (row number, col) -> value
+        self.modified = 0
+        self.col_count = len(HEADER)
+        self.spreadsheet = FakeSpreadsheet(self)
+        self._lock = threading.Lock()
+
+    def _base_row(self, i):
+        rnd = random.Random(self.seed * 1000003 + i)
+        day = date.today() - timedelta(days=rnd.randrange(365))
+        miles = rnd.randrange(50, 2500)
+        rate = rnd.randrange(300, 8000)
+        user = rnd.randrange(self.users)
+        return [day.isoformat(), f"{rnd.randrange(10000, 99999)}", f"{rnd.randrange(10000, 99999)}", "", "",
+                str(miles), str(rate), "", format(rate / miles, ".2f"), rnd.choice(TRAILERS), f"@user{user}",
+                "", "", f"@user{user}", str(1000 + user), f"b{i:07x}"]
+
+    def _row(self, number):
+        i = number - 2
+        row = self._base_row(i) if i < self.base_rows else list(self.extra[i - self.base_rows])
+        for col in range(len(row)):
+            if (number, col + 1) in self.edits:
+                row[col] = self.edits[(number, col + 1)]
+        return row
+
+    def _wait(self, operation):
+        count("sheets", operation)
+        time.sleep(self.latency)
+
+    def row_count_now(self):
+        return self.base_rows + len(self.extra) + 1
+
+    # --- gspread.Worksheet API used by main.py ---
+
+    def get_all_values(self):
+        self._wait("get_all_values")
+        with self._lock:
+            return [list(self.header)] + [self._row(n) for n in range(2, self.row_count_now() + 1)]
+
+    def get_values(self, range_name):
+        self._wait("get_values")
+        first = int("".join(ch for ch in range_name.split(":")[0] if ch.isdigit()))
+        with self._lock:
+            return [self._row(n) for n in range(first, self.row_count_now() + 1)]
+
+    def row_values(self, number):
+        self._wait("row_values")
+        with self._lock:
+            return list(self.header) if number == 1 else self._row(number)
+
+    def append_rows(self, rows, **kwargs):
+        self._wait("append_rows")
+        with self._lock:
+            start = self.row_count_now() + 1
+            self.extra.extend([str(value) for value in row] for row in rows)
+            self.modified += 1
+            return {"updates": {"updatedRange": f"Sheet1!A{start}:P{self.row_count_now()}"}}
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row], **kwargs)
+
+    def update_cell(self, row, col, value):
+        self._wait("update_cell")
+        with self._lock:
+            if row == 1:
+                self.header += [""] * (col - len(self.header))
+                self.header[col - 1] = value
+            else:
+                self.edits[(row, col)] = str(value)
+            self.modified += 1
+
+    def batch_update(self, data, **kwargs):
+        self._wait("batch_update")
+        with self._lock:
+            for item in data:
+                col, row = _a1_to_colrow(item["range"].split(":")[0])
+                for n, values in enumerate(item["values"]):
+                    for k, value in enumerate(values):
+                        self.edits[(row + n, col + k)] = str(value)
+            self.modified += 1
+
+    def find(self, query, in_column=None):
+        self._wait("find")
+        with self._lock:
+            for number in range(2, self.row_count_now() + 1):
+                row = self._row(number)
+                cols = [in_column] if in_column else range(1, len(row) + 1)
+                for col in cols:
+                    if row[col - 1] == query:
+                        return SimpleNamespace(row=number, col=col, value=query)
+        return None
+
+    def add_cols(self, n):
+        self._wait("add_cols")
+        self.col_count += n
+
+
+def _a1_to_colrow(a1):
+    letters = "".join(ch for ch in a1 if ch.isalpha())
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch.upper()) - 64
+    return col, int("".join(ch for ch in a1 if ch.isdigit()))
+
+
+def install_fake_sheet(sheet):
+    def fake_sheet_call(fn, *args, **kwargs):
+        method = getattr(gspread.Worksheet, getattr(fn, "__name__", ""), None)
+        if method is fn:
+            return getattr(sheet, fn.__name__)(*args, **kwargs)
+        return fn(sheet, *args, **kwargs)
+
+    main.sheet_call = fake_sheet_call
+
+
+class FakeZipTable:
+    # те же координаты, что отдаёт lookup — для оценки миль в /submit
+    lat = array("f", (34.0 + slot % 7 for slot in range(main.ZIP_SLOTS)))
+    lon = array("f", (-118.0 + slot % 5 for slot in range(main.ZIP_SLOTS)))
+
+    def lookup(self, slot):
+        count("geocode", "lookup")
+        return f"City{slot % 97}", "CA", 34.0 + slot % 7, -118.0 + slot % 5
+
+
+class FakeFirestore:
+    """Just enough of the async client for the outbox flush and the primary-mode reads."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.docs = {}
+
+    def collection(self, name):
+        return SimpleNamespace(document=lambda load_id: load_id)
+
+    def batch(self):
+        firestore = self
+        writes = []
+
+        class Batch:
+            def set(self, ref, fields, merge=False):
+                writes.append((ref, fields))
+
+            async def commit(self):
+                count("firestore", "batch_commit")
+                await asyncio.sleep(firestore.latency)
+                for ref, fields in writes:
+                    firestore.docs.setdefault(ref, {}).update(fields)
+
+        return Batch()
+
+    async def query(self, user_id, start=None, end=None, limit=None):
+        count("firestore", "query")
+        await asyncio.sleep(self.latency)
+        docs = [doc for doc in self.docs.values() if doc.get("User ID") == str(user_id)
+                and (start is None or start.isoformat() <= doc.get("Date", "") <= end.isoformat())]
+        docs.sort(key=lambda doc: doc.get("Date", ""), reverse=True)
+        return docs[:limit] if limit else docs
+
+
+def install_fake_firestore(firestore):
+    main.FIRESTORE_MODE = "primary"
+    main._async_db = firestore
+    main.firestore_latest_loads = lambda user_id, n: firestore.query(user_id, limit=n)
+    main.firestore_loads_between = lambda user_id, start, end: firestore.query(user_id, start, end)
+
+
+def install_fake_fmcsa(latency):
+    async def handler(request):
+        count("fmcsa", "get")
+        await asyncio.sleep(latency)
+        number = request.url.path.rsplit("/", 1)[-1]
+        if number == "999999":
+            return httpx.Response(200, json={"content": []})
+        return httpx.Response(200, json={"content": [{
+            "legalName": f"Broker {number}", "dotNumber": number, "docketNumber": f"MC{number}",
+            "phoneNumber": "555-0100", "entityStatus": "A",
+        }]})
+
+    main.fmcsa_client._cache.clear()
+    main.fmcsa_client._http = httpx.AsyncClient(base_url=main.FMCSA_BASE_URL, transport=httpx.MockTransport(handler))
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text="", reply_markup=None, message_id=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.text = text
+        self.reply_markup = reply_markup
+        self.message_id = message_id or bot.next_id()
+
+    async def reply_text(self, text, reply_markup=None, parse_mode=None):
+        return await self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+
+
+class FakeBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self._ids = 0
+        self.sent = defaultdict(list)  # chat_id -> [FakeMessage]
+
+    def next_id(self):
+        self._ids += 1
+        return self._ids
+
+    async def _call(self, operation):
+        count("telegram", operation)
+        await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        await self._call("sendMessage")
+        message = FakeMessage(self, chat_id, text, reply_markup)
+        self.sent[chat_id].append(message)
+        return message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, parse_mode=None):
+        await self._call("editMessageText")
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self._call("deleteMessages")
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot, message, data):
+        self.bot = bot
+        self.message = message
+        self.data = data
+
+    async def answer(self):
+        await self.bot._call("answerCallbackQuery")
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        await self.bot._call("editMessageText")
+        self.message.text = text
+        self.message.reply_markup = reply_markup
+
+    async def edit_message_reply_markup(self, reply_markup=None):
+        await self.bot._call("editMessageReplyMarkup")
+        self.message.reply_markup = reply_markup
+
+
+class FakeJobQueue:
+    def __init__(self, app):
+        self.app = app
+        self.pending = {}  # handle -> name
+
+    def run_once(self, callback, when, data=None, name=None, chat_id=None, user_id=None):
+        loop = asyncio.get_running_loop()
+        job = SimpleNamespace(data=data, name=name, chat_id=chat_id, user_id=user_id)
+        context = SimpleNamespace(bot=self.app.bot, job=job, job_queue=self, application=self.app)
+
+        def fire():
+            del self.pending[handle]
+            self.app.create_task(callback(context))
+
+        handle = loop.call_later(when, fire)
+        self.pending[handle] = name
+        return job
+
+    def get_jobs_by_name(self, name):
+        return [handle for handle, job_name in self.pending.items() if job_name == name]
+
+
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+        self.job_queue = FakeJobQueue(self)
+        self.tasks = set()
+
+    def create_task(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def settle(self):
+        """Waits until no jobs or background tasks are left."""
+        while self.job_queue.pending or self.tasks:
+            await asyncio.sleep(0.05)
+            if self.tasks:
+                await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+class FakeUser:
+    def __init__(self, app, n):
+        self.app = app
+        self.id = 1000 + n
+        self.username = f"user{n}"
+        self.full_name = f"User {n}"
+        self.chat_id = 5000 + n
+        self.user_data = {}
+
+    def context(self, args=None):
+        return SimpleNamespace(bot=self.app.bot, user_data=self.user_data, args=args or [],
+                               job_queue=self.app.job_queue, application=self.app)
+
+    def _update(self, message=None, callback_query=None):
+        return SimpleNamespace(
+            effective_user=self,
+            effective_chat=SimpleNamespace(id=self.chat_id),
+            effective_message=message or callback_query.message,
+            message=message,
+            callback_query=callback_query,
+        )
+
+    def text(self, text):
+        return self._update(message=FakeMessage(self.app.bot, self.chat_id, text))
+
+    def tap(self, data, message=None):
+        message = message or FakeMessage(self.app.bot, self.chat_id)
+        return self._update(callback_query=FakeCallbackQuery(self.app.bot, message, data))
+
+    def last_buttons(self, prefix):
+        for message in reversed(self.app.bot.sent[self.chat_id]):
+            for row in getattr(message.reply_markup, "inline_keyboard", None) or ():
+                for button in row:
+                    if button.callback_data and button.callback_data.startswith(prefix):
+                        return button.callback_data
+        return None
+
+
+# === Scenarios ===
+
+latencies = defaultdict(list)  # handler -> [seconds]
+errors = Counter()
+
+
+async def step(name, handler, update, context):
+    started = time.perf_counter()
+    try:
+        return await handler(update, context)
+    except Exception as e:
+        errors[(name, type(e).__name__)] += 1
+    finally:
+        latencies[name].append(time.perf_counter() - started)
+
+
+async def scenario_submit(user, rnd):
+    await step("submit", main.submit, user.text("/submit"), user.context())
+    for value in [f"{rnd.randrange(10000, 99999)}", rnd.choice(["TX", f"{rnd.randrange(10000, 99999)}"])]:
+        await step("handle_submit_input", main.handle_submit_input, user.text(value), user.context())
+    estimate = user.last_buttons("miles_")  # подсказка по ZIP, если обе точки — ZIP
+    if estimate:
+        await step("handle_submit_callback", main.handle_submit_callback, user.tap(estimate), user.context())
+    else:
+        await step("handle_submit_input", main.handle_submit_input, user.text(str(rnd.randrange(50, 2500))),
+                   user.context())
+    await step("handle_submit_input", main.handle_submit_input, user.text(str(rnd.randrange(300, 8000))), user.context())
+    await step("handle_submit_callback", main.handle_submit_callback, user.tap(rnd.choice(TRAILERS)), user.context())
+    await step("handle_submit_input", main.handle_submit_input, user.text("bench"), user.context())
+
+
+async def scenario_stats(user, rnd):
+    await step("stats_start", main.stats_start, user.text("/stats"), user.context())
+    period = rnd.choice(["today", "this_week", "this_month"])
+    await step("handle_stats_selection", main.handle_stats_selection, user.tap(period), user.context())
+
+
+async def scenario_my_stats(user, rnd):
+    await step("my_stats_start", main.my_stats_start, user.text("/my_stats"), user.context())
+    day = rnd.choice(["monday", "wednesday", "sunday"])
+    await step("handle_my_day_selection", main.handle_my_day_selection, user.tap(day), user.context())
+
+
+async def scenario_my_loads(user, rnd):
+    await step("my_loads", main.my_loads, user.text("/my_loads"), user.context())
+
+
+async def scenario_edit(user, rnd):
+    await step("my_loads", main.my_loads, user.text("/my_loads"), user.context())
+    load = user.last_buttons("edit_")
+    if load is None:
+        return
+    menu = FakeMessage(user.app.bot, user.chat_id)
+    await step("start_edit_load", main.start_edit_load, user.tap(load, menu), user.context())
+    if str(user.id) not in main.edit_state:
+        return
+    await step("handle_edit_field_selection", main.handle_edit_field_selection,
+               user.tap("editfield_rate", menu), user.context())
+    await step("handle_edit_input", main.handle_edit_input, user.text(str(rnd.randrange(300, 8000))), user.context())
+
+
+async def scenario_broker(user, rnd):
+    await step("broker_lookup", main.broker_lookup, user.text("/broker"), user.context([rnd.choice(BROKERS)]))
+
+
+SCENARIOS = {
+    "submit": scenario_submit,
+    "stats": scenario_stats,
+    "my_stats": scenario_my_stats,
+    "my_loads": scenario_my_loads,
+    "edit": scenario_edit,
+    "broker": scenario_broker,
+}
+MIX = ["submit"] * 3 + ["stats"] * 3 + ["my_stats"] * 2 + ["my_loads"] * 2 + ["edit", "broker", "broker"]
+
+
+# === Runner ===
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def install_fakes(rows, args):
+    """Points main.py at the fake backends and loads the sheet; returns the load time."""
+    sheet = FakeSheet(rows, args.sheet_users, args.sheets_latency, seed=args.seed)
+    install_fake_sheet(sheet)
+    install_fake_fmcsa(args.fmcsa_latency)
+    main._zip_table = FakeZipTable()
+    main.zip_lookup.cache_clear()
+    if args.firestore:
+        install_fake_firestore(FakeFirestore(args.firestore_latency))
+    main.outbox = main.Outbox(os.path.join(tempfile.mkdtemp(prefix="rateguard-bench-"), "outbox.sqlite3"))
+    main.edit_state.clear()
+
+    started = time.perf_counter()
+    await main.run_blocking("load", main.load_store.reload)
+    load_seconds = time.perf_counter() - started
+    calls.clear()
+    return load_seconds
+
+
+async def run_size(rows, args):
+    latencies.clear()
+    errors.clear()
+    calls.clear()
+
+    bot = FakeBot(args.telegram_latency)
+    app = FakeApplication(bot)
+    load_seconds = await install_fakes(rows, args)
+
+    # API calls per command: one user, one command at a time, background work included
+    per_command = {}
+    probe = FakeUser(app, 0)
+    for name, scenario in SCENARIOS.items():
+        before = Counter(calls)
+        await scenario(probe, random.Random(args.seed))
+        await main.flush_outbox(None)
+        await main.publisher.drain()
+        await app.settle()
+        per_command[name] = {key: n - before[key] for key, n in calls.items() if n - before[key]}
+
+    latencies.clear()
+    calls.clear()
+    users = [FakeUser(app, n) for n in range(args.users)]
+
+    async def user_loop(user):
+        rnd = random.Random(args.seed + user.id)
+        for _ in range(args.rounds):
+            await SCENARIOS[rnd.choice(MIX)](user, rnd)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(user) for user in users))
+    wall = time.perf_counter() - started
+    await main.flush_outbox(None)
+    await main.publisher.drain()
+    await app.settle()
+
+    return {"rows": rows, "load_seconds": load_seconds, "wall": wall, "per_command": per_command,
+            "latencies": {name: list(values) for name, values in latencies.items()},
+            "errors": dict(errors), "calls": dict(calls)}
+
+
+def report(result, traced):
+    print(f"\n=== {result['rows']:,} rows — initial sheet load {result['load_seconds']:.2f}s, "
+          f"concurrent phase {result['wall']:.2f}s ===")
+    print(f"{'handler':<30}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(result["latencies"].items()):
+        print(f"{name:<30}{len(values):>7}"
+              + "".join(f"{percentile(values, p) * 1000:>10.1f}" for p in (0.5, 0.95, 0.99)))
+
+    print("\nbackend calls per command (one command, background work included):")
+    for name, counts in result["per_command"].items():
+        text = ", ".join(f"{backend}.{operation}={n}" for (backend, operation), n in sorted(counts.items()))
+        print(f"  {name:<10} {text or '—'}")
+
+    if result["errors"]:
+        print("\nerrors:")
+        for (name, error), n in sorted(result["errors"].items()):
+            print(f"  {name}: {error} x{n}")
+
+    memory = f"max RSS {rss_mb():.0f} MB"
+    if traced:
+        current, peak = tracemalloc.get_traced_memory()
+        memory += f", traced current {current / 2 ** 20:.0f} MB, peak {peak / 2 ** 20:.0f} MB"
+    print(f"\nmemory: {memory}")
+
+
+# === Webhook harness ===
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "RateGuard", "username": "rateguard_bench_bot"}
+WEBHOOK_SECRET = "bench-secret"
+WEBHOOK_MIX = ["submit"] * 3 + ["stats"] * 3 + ["my_stats"] * 2 + ["my_loads"] * 2 + ["broker"] * 2
+
+
+class FakeBotApi(HTTPXRequest):
+    """Bot API transport for the real Application: every method is answered locally after `latency`."""
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self._message_ids = itertools.count(1)
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        count("telegram", endpoint)
+        await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = {"message_id": params.get("message_id") or next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": params.get("chat_id"), "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+_update_ids = itertools.count(1)
+
+
+def _sender(n):
+    return {"id": 1000 + n, "is_bot": False, "first_name": f"User {n}", "username": f"user{n}"}
+
+
+def message_update(n, text):
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return {"update_id": next(_update_ids), "message": {
+        "message_id": next(_update_ids), "date": int(time.time()), "text": text, "entities": entities,
+        "chat": {"id": 5000 + n, "type": "private"}, "from": _sender(n)}}
+
+
+def callback_update(n, data):
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": _sender(n), "chat_instance": "bench", "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "text": "menu",
+                    "chat": {"id": 5000 + n, "type": "private"}}}}
+
+
+def webhook_script(name, n, rnd):
+    """(label, update) pairs for one command, in the order a user would send them."""
+    if name == "submit":
+        values = [f"{rnd.randrange(10000, 99999)}", rnd.choice(["TX", f"{rnd.randrange(10000, 99999)}"])]
+        return ([("/submit", message_update(n, "/submit"))]
+                + [("submit text", message_update(n, value)) for value in values]
+                # кнопка «Keep N mi» принимается без сверки с оценкой
+                + [("submit button", callback_update(n, f"miles_{rnd.randrange(50, 2500)}")),
+                   ("submit text", message_update(n, str(rnd.randrange(300, 8000)))),
+                   ("submit button", callback_update(n, rnd.choice(TRAILERS))),
+                   ("submit text", message_update(n, "bench"))])
+    if name == "stats":
+        return [("/stats", message_update(n, "/stats")),
+                ("stats button", callback_update(n, rnd.choice(["today", "this_week", "this_month"])))]
+    if name == "my_stats":
+        return [("/my_stats", message_update(n, "/my_stats")),
+                ("my_stats button", callback_update(n, rnd.choice(["monday", "wednesday", "sunday"])))]
+    if name == "my_loads":
+        return [("/my_loads", message_update(n, "/my_loads"))]
+    return [("/broker", message_update(n, f"/broker {rnd.choice(BROKERS)}"))]
+
+
+async def run_webhook(rows, args):
+    latencies.clear()
+    errors.clear()
+    load_seconds = await install_fakes(rows, args)
+
+    app = main.build_application(FakeBotApi(args.telegram_latency))
+    waiting = {}  # update_id -> future, resolved once group 0 is done with the update
+
+    async def handled(update, context):
+        future = waiting.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    app.add_handler(TypeHandler(Update, handled), group=1)
+    await app.initialize()
+    await app.updater.start_webhook(listen="127.0.0.1", port=args.webhook_port, url_path="bench",
+                                    secret_token=WEBHOOK_SECRET)
+    await app.start()
+    calls.clear()
+
+    url = f"http://127.0.0.1:{args.webhook_port}/bench"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    acks = []
+    loop = asyncio.get_running_loop()
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.users), timeout=30) as http:
+        forged = await http.post(url, json=message_update(0, "/my_loads"), headers={"X-Telegram-Bot-Api-Secret-Token": "x"})
+        if forged.status_code != 403:
+            errors[("secret check", f"HTTP {forged.status_code}")] += 1
+
+        async def post(label, payload):
+            future = waiting[payload["update_id"]] = loop.create_future()
+            started = time.perf_counter()
+            response = await http.post(url, json=payload, headers=headers)
+            acks.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                waiting.pop(payload["update_id"], None)
+                errors[(label, f"HTTP {response.status_code}")] += 1
+                return
+            try:
+                finished = await asyncio.wait_for(future, args.webhook_timeout)
+            except asyncio.TimeoutError:
+                errors[(label, "timeout")] += 1
+                return
+            latencies[label].append(finished - started)
+
+        async def user_loop(n):
+            rnd = random.Random(args.seed + n)
+            for _ in range(args.rounds):
+                for label, payload in webhook_script(rnd.choice(WEBHOOK_MIX), n, rnd):
+                    await post(label, payload)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_loop(n) for n in range(1, args.users + 1)))
+        wall = time.perf_counter() - started
+
+    await app.updater.stop()
+    await app.stop()
+    await main.flush_outbox(None)
+    await main.publisher.drain()
+    await app.shutdown()
+    return {"rows": rows, "load_seconds": load_seconds, "wall": wall, "acks": acks,
+            "latencies": {name: list(values) for name, values in latencies.items()},
+            "errors": dict(errors), "calls": dict(calls)}
+
+
+def report_webhook(result):
+    updates = sum(len(values) for values in result["latencies"].values())
+    print(f"\n=== webhook, {result['rows']:,} rows — {updates} updates in {result['wall']:.2f}s "
+          f"({updates / result['wall']:.0f}/s) ===")
+    print(f"{'update → handler done':<30}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(result["latencies"].items()) + [("(HTTP ack)", result["acks"])]:
+        if values:
+            print(f"{name:<30}{len(values):>7}"
+                  + "".join(f"{percentile(values, p) * 1000:>10.1f}" for p in (0.5, 0.95, 0.99)))
+    if result["errors"]:
+        print("\nerrors:")
+        for (name, error), n in sorted(result["errors"].items()):
+            print(f"  {name}: {error} x{n}")
+    print(f"\nmemory: max RSS {rss_mb():.0f} MB")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="sheet sizes to run (1k to 1M)")
+    parser.add_argument("--users", type=int, default=50, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=5, help="commands per user")
+    parser.add_argument("--sheet-users", type=int, default=200, help="distinct users in the generated sheet")
+    parser.add_argument("--sheets-latency", type=float, default=0.15)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--fmcsa-latency", type=float, default=0.3)
+    parser.add_argument("--firestore-latency", type=float, default=0.05)
+    parser.add_argument("--firestore", action="store_true", help="run with FIRESTORE_MODE=primary")
+    parser.add_argument("--trace-memory", action="store_true", help="tracemalloc peak (slow)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--webhook", action="store_true",
+                        help="post synthetic updates to the real application behind the webhook server")
+    parser.add_argument("--webhook-port", type=int, default=8444)
+    parser.add_argument("--webhook-timeout", type=float, default=60, help="seconds to wait for one update")
+    args = parser.parse_args()
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    async def run():
+        for rows in args.rows:
+            if args.webhook:
+                report_webhook(await run_webhook(rows, args))
+            else:
+                report(await run_size(rows, args), args.trace_memory)
+        await main.fmcsa_client.aclose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main_cli()
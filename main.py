@@ -1,55 +1,1058 @@
+import time
+_process_started = time.perf_counter()  # для отчёта о холодном старте
+
 import os
-import firebase_admin
-from firebase_admin import credentials, firestore
 import json
 
-import pandas as pd
-import gspread
-import pgeocode
-import requests
+import argparse
+import contextlib
+import csv
+import fcntl
+import gzip
+import hashlib
+import io
+import importlib.util
+import logging
+import mmap
+import secrets
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import zipfile
+
+import httpx
 import asyncio
-from datetime import datetime, timedelta
+import functools
+import bisect
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes,
-    ConversationHandler, MessageHandler, CallbackQueryHandler, filters
+    ApplicationBuilder, BaseUpdateProcessor, CommandHandler, ContextTypes,
+    ConversationHandler, MessageHandler, CallbackQueryHandler, filters,
+    PersistenceInput, PicklePersistence
 )
-from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
 
 
 load_dotenv()
+logger = logging.getLogger("rateguard")
 TOKEN = os.getenv("BOT_TOKEN")
 
 # Получаем ключ из переменной среды
 service_account_info = json.loads(os.getenv("SERVICE_ACCOUNT_JSON"))
 
-# Инициализация Firebase
-cred = credentials.Certificate(service_account_info)
-firebase_admin.initialize_app(cred)
+# Firebase и Firestore поднимаются при первом обращении (get_async_db), не при импорте
+_async_db = None
+
+
+def get_async_db():
+    """Async Firestore client; honours FIRESTORE_EMULATOR_HOST like every Google client."""
+    global _async_db
+    if _async_db is None:
+        import firebase_admin
+        from firebase_admin import credentials, firestore_async
 
-# Подключаемся к Firestore
-db = firestore.client()
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate(service_account_info))
+        _async_db = firestore_async.client()
+    return _async_db
 
-FMCSA_API_KEY = "91a883766f99d16ed141dd4a254158a898fba793"
+FMCSA_API_KEY = os.getenv("FMCSA_API_KEY", "91a883766f99d16ed141dd4a254158a898fba793")
 
 PICKUP, DELIVERY, TOTAL_MILES, RATE, TRAILER, COMMENT, CANCEL = range(7)
 STATS_SELECT, MY_STATS_DAY = range(6, 8)
 
-edit_state = {}  # user_id: {row_index, message_ids, step}
+# === Conversation state ===
+# Per-user state that lives between updates: expires CONVERSATION_TTL seconds
+# after the last touch, and the least recently used entries are evicted past
+# max_size. With STATE_PATH set the stores are kept in bot_data and saved by
+# PicklePersistence together with user_data and the ConversationHandler states.
+
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "3600"))
+CONVERSATION_MAX = int(os.getenv("CONVERSATION_MAX", "10000"))
+STATE_PATH = os.getenv("STATE_PATH", "")  # пусто — состояние только в памяти
+STATE_FLUSH_INTERVAL = int(os.getenv("STATE_FLUSH_INTERVAL", "30"))
+
+
+class EditState:
+    __slots__ = ("load_id", "row_index", "field", "chat_id", "menu_message_id", "question_msg_id")
+
+    def __init__(self, load_id, row_index, chat_id, menu_message_id):
+        self.load_id = load_id  # "" у старых строк без Load ID — тогда правим по row_index
+        self.row_index = row_index
+        self.field = None
+        self.chat_id = chat_id
+        self.menu_message_id = menu_message_id
+        self.question_msg_id = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, EditState) and self.__getstate__() == other.__getstate__()
+
+
+class ConversationStore:
+    """TTL + LRU mapping; only touched from the event loop, so no lock."""
+
+    def __init__(self, ttl=CONVERSATION_TTL, max_size=CONVERSATION_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()  # key -> (expires_at, value); time.time(), переживает рестарт
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        if item[0] < time.time():
+            del self._items[key]
+            return default
+        self._items[key] = (time.time() + self.ttl, item[1])
+        self._items.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        self._items[key] = (time.time() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __eq__(self, other):
+        # PTB сравнивает bot_data с прошлым снимком, чтобы не писать файл зря
+        return isinstance(other, ConversationStore) and self._items == other._items
+
+    def expire(self):
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self._items.items() if expires_at < now]:
+            del self._items[key]
+
+    def adopt(self, stored):
+        """Takes over the entries of a store restored by persistence."""
+        if isinstance(stored, ConversationStore):
+            self._items = stored._items
+            self.expire()
+
+
+edit_state = ConversationStore()               # user_id -> EditState
+submit_current_messages = ConversationStore()  # chat_id -> сообщение с кнопками текущего шага
+conversation_stores = {"edit_state": edit_state, "submit_current_messages": submit_current_messages}
+
+
+async def expire_conversation_state(context):
+    for store in conversation_stores.values():
+        store.expire()
+
+# === Metrics ===
+# In-process counters and histograms, rendered in the Prometheus text format
+# by a small Flask app on METRICS_PORT (see start_metrics_server). Updated from
+# the event loop and from I/O threads, hence the lock.
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — не поднимать endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics_lock = threading.Lock()
+_metrics = []
+_gauges = []  # (name, help, fn() -> {labels tuple: value})
+
+
+def _label_text(names, values, extra=""):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricCounter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with _metrics_lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class MetricHistogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # labels -> [counts per bucket..., sum, count]
+        _metrics.append(self)
+
+    def observe(self, seconds, *label_values):
+        with _metrics_lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for n, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[n] += 1
+            entry[-2] += seconds
+            entry[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, entry in sorted(self.values.items()):
+            labels = _label_text(self.labels, label_values)
+            for bound, n in zip(self.buckets + ("+Inf",), entry[:len(self.buckets)] + [entry[-1]]):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, label_values, le)} {n}")
+            lines.append(f"{self.name}_sum{labels} {entry[-2]}")
+            lines.append(f"{self.name}_count{labels} {entry[-1]}")
+        return lines
+
+
+def gauge(name, help_text, labels=()):
+    """Registers fn() -> {label values: value} as a gauge read at scrape time."""
+    def register(fn):
+        _gauges.append((name, help_text, labels, fn))
+        return fn
+    return register
+
+
+handler_latency = MetricHistogram("rateguard_handler_seconds", "Handler latency per handler and conversation step",
+                                  ("handler", "step"))
+handler_errors = MetricCounter("rateguard_handler_errors_total", "Handlers that raised", ("handler",))
+backend_calls = MetricCounter("rateguard_backend_calls_total", "Calls to external backends", ("backend", "operation"))
+backend_latency = MetricHistogram("rateguard_backend_seconds", "Backend call latency", ("backend",))
+backend_errors = MetricCounter("rateguard_backend_errors_total", "Failed backend calls", ("backend",))
+backend_retries = MetricCounter("rateguard_backend_retries_total", "Retried backend calls", ("backend",))
+
+
+def instrumented(step=None):
+    """Times a handler into rateguard_handler_seconds; step(update, context) names the conversation step."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            label = step(update, context) if step else ""
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception:
+                handler_errors.inc(handler.__name__)
+                raise
+            finally:
+                handler_latency.observe(time.perf_counter() - started, handler.__name__, label)
+        return wrapper
+    return decorate
+
+
+def render_metrics():
+    with _metrics_lock:
+        lines = [line for metric in _metrics for line in metric.render()]
+    for name, help_text, labels, fn in _gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        try:
+            values = fn()
+        except Exception:
+            logger.exception("Gauge %s failed", name)
+            continue
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{name}{_label_text(labels, label_values)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    from flask import Flask, Response
+    from werkzeug.serving import make_server
+
+    metrics_app = Flask("rateguard-metrics")
+
+    @metrics_app.route("/metrics")
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    server = make_server(host, port, metrics_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    return server
+
+
+# === Blocking backends ===
+# gspread, requests, pgeocode and the Firestore client are synchronous. They run
+# on a shared thread pool behind a per-backend semaphore and timeout, so a slow
+# Sheets call holds one Sheets slot instead of the whole event loop.
+
+BACKEND_LIMITS = {
+    "sheets": int(os.getenv("SHEETS_CONCURRENCY", "4")),
+    "fmcsa": int(os.getenv("FMCSA_CONCURRENCY", "8")),  # размер пула httpx, не потоков
+    "geocode": int(os.getenv("GEOCODE_CONCURRENCY", "2")),
+    "firestore": int(os.getenv("FIRESTORE_CONCURRENCY", "4")),
+    "outbox": 1,
+    "export": int(os.getenv("EXPORT_CONCURRENCY", "1")),
+    "import": 1,
+    "fmcsa_index": 1,
+    "load": 1,  # полное чтение листа: первая загрузка и перезагрузки
+}
+BACKEND_TIMEOUTS = {
+    "sheets": float(os.getenv("SHEETS_TIMEOUT", "30")),
+    "fmcsa": float(os.getenv("FMCSA_TIMEOUT", "15")),
+    "geocode": float(os.getenv("GEOCODE_TIMEOUT", "10")),
+    "firestore": float(os.getenv("FIRESTORE_TIMEOUT", "15")),
+    "outbox": 10.0,
+    "export": float(os.getenv("EXPORT_TIMEOUT", "600")),
+    "import": float(os.getenv("IMPORT_TIMEOUT", str(6 * 3600))),
+    "fmcsa_index": float(os.getenv("FMCSA_INDEX_TIMEOUT", "3600")),
+    "load": float(os.getenv("LOAD_TIMEOUT", "1800")),
+}
+
+_io_executor = ThreadPoolExecutor(
+    max_workers=sum(limit for backend, limit in BACKEND_LIMITS.items() if backend != "fmcsa"),
+    thread_name_prefix="io",
+)
+_backend_semaphores = {}
+
+
+async def run_blocking(backend, fn, *args, **kwargs):
+    """Runs fn(*args, **kwargs) on the I/O pool, at most BACKEND_LIMITS[backend] at a time."""
+    semaphore = _backend_semaphores.get(backend)
+    if semaphore is None:
+        semaphore = _backend_semaphores[backend] = asyncio.Semaphore(BACKEND_LIMITS[backend])
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            future = loop.run_in_executor(_io_executor, functools.partial(fn, *args, **kwargs))
+            return await asyncio.wait_for(future, BACKEND_TIMEOUTS[backend])
+        except Exception:
+            backend_errors.inc(backend)
+            raise
+        finally:
+            backend_latency.observe(time.perf_counter() - started, backend)
+
+
+async def run_async(backend, awaitable):
+    """Same limits and timeout as run_blocking, for backends with a native async client."""
+    semaphore = _backend_semaphores.get(backend)
+    if semaphore is None:
+        semaphore = _backend_semaphores[backend] = asyncio.Semaphore(BACKEND_LIMITS[backend])
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(awaitable, BACKEND_TIMEOUTS[backend])
+        except Exception:
+            backend_errors.inc(backend)
+            raise
+        finally:
+            backend_latency.observe(time.perf_counter() - started, backend)
+
+
+@gauge("rateguard_backend_in_flight", "Backend calls running or waiting for the pool", ("backend",))
+def _backend_in_flight():
+    return {(backend,): BACKEND_LIMITS[backend] - semaphore._value
+            for backend, semaphore in list(_backend_semaphores.items())}
+
+
+# === Google Sheets client ===
+# One authorized client and worksheet handle per process. The OAuth token is
+# refreshed by the authorized session itself; we only rebuild the client when
+# Google rejects the credentials (401) or the handle is explicitly reset.
+
+SHEET_NAME = "RateGuard_Leads"
+SHEET_SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+SHEET_POOL_SIZE = int(os.getenv("SHEET_POOL_SIZE", "10"))
+
+_sheet_lock = threading.Lock()
+_sheet_client = None
+_sheet = None
+_sheet_key = None  # id таблицы, чтобы не искать её по имени через Drive при переподключении
 
-nomi = pgeocode.Nominatim('us')
-user_stats_state = {}
 
-def get_sheet():
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    import json
-    creds_json = os.getenv("SERVICE_ACCOUNT_JSON")
-    creds_dict = json.loads(creds_json)
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+def _connect_sheet():
+    global _sheet_client, _sheet, _sheet_key
+    # gspread, oauth2client и requests — треть времени импорта main.py; грузим их с первым подключением
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    from requests.adapters import HTTPAdapter
+
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(service_account_info, SHEET_SCOPE)
     client = gspread.authorize(creds)
-    return client.open("RateGuard_Leads").sheet1
+
+    # keep-alive: один пул соединений на процесс вместо нового TCP/TLS на каждый вызов
+    session = getattr(client, "session", None) or client.http_client.session
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=SHEET_POOL_SIZE)
+    session.mount("https://", adapter)
+    if hasattr(client, "set_timeout"):
+        # поток не должен висеть дольше, чем его ждёт run_blocking
+        client.set_timeout(BACKEND_TIMEOUTS["sheets"])
+
+    if _sheet_key:
+        spreadsheet = client.open_by_key(_sheet_key)
+    else:
+        spreadsheet = client.open(SHEET_NAME)
+        _sheet_key = spreadsheet.id
+
+    _sheet_client = client
+    _sheet = spreadsheet.sheet1
+    logger.info("Connected to Google Sheet %s", SHEET_NAME)
+
+
+def get_sheet(reconnect=False):
+    with _sheet_lock:
+        if reconnect or _sheet is None:
+            _connect_sheet()
+        return _sheet
+
+
+def _is_auth_error(error):
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None) or getattr(error, "code", None)
+    return status == 401
+
+
+def sheet_call(fn, *args, **kwargs):
+    """
+    Calls fn(sheet, *args, **kwargs) on the shared worksheet handle.
+    If the credentials were revoked or expired, reconnects once and retries.
+    """
+    import gspread
+    backend_calls.inc("sheets", getattr(fn, "__name__", "call"))
+    try:
+        return fn(get_sheet(), *args, **kwargs)
+    except gspread.exceptions.APIError as e:
+        if not _is_auth_error(e):
+            raise
+        logger.warning("Sheets auth expired, reconnecting")
+        backend_retries.inc("sheets")
+        return fn(get_sheet(reconnect=True), *args, **kwargs)
+
+# === Load store ===
+# Resident copy of RateGuard_Leads. The sheet is downloaded once; afterwards our
+# own writes are applied locally and a periodic job fetches only the rows that
+# appeared past the last known row. A full reload happens only when the
+# spreadsheet changed without us writing to it (someone edited or deleted rows
+# by hand), which we detect through its Drive modification time.
+
+LOAD_SYNC_INTERVAL = int(os.getenv("LOAD_SYNC_INTERVAL", "60"))
+LOAD_FULL_SYNC_INTERVAL = int(os.getenv("LOAD_FULL_SYNC_INTERVAL", "1800"))
+
+
+def _sheet_modified_time(sheet):
+    spreadsheet = sheet.spreadsheet
+    getter = getattr(spreadsheet, "get_lastUpdateTime", None)  # gspread 6: каждый раз спрашивает Drive
+    if getter:
+        return getter()
+    # gspread 5: lastUpdateTime запомнен при открытии (а после open_by_key его нет вовсе) — спрашиваем Drive сами
+    from gspread.urls import DRIVE_FILES_API_V3_URL
+
+    response = spreadsheet.client.request(
+        "get", f"{DRIVE_FILES_API_V3_URL}/{spreadsheet.id}",
+        params={"fields": "modifiedTime", "supportsAllDrives": True},
+    )
+    return response.json()["modifiedTime"]
+
+
+def _updated_start_row(response):
+    """Первая строка, в которую легли данные append_row/append_rows ("Sheet1!A12:O13" -> 12)."""
+    updated_range = response.get("updates", {}).get("updatedRange", "")
+    cell = updated_range.split("!")[-1].split(":")[0]
+    digits = "".join(ch for ch in cell if ch.isdigit())
+    return int(digits) if digits else None
+
+
+class LoadStore:
+    """
+    Rows of the sheet as tuples in sheet order: rows[i] is sheet row i + 2.
+    Values are numericised the same way get_all_records() does it.
+
+    Listeners get add(store, i, row) and replace(store, i, old, new) calls under
+    store.lock. On a reload a fresh instance of each listener is reset(snapshot)
+    outside the lock and installed with listener.adopt(fresh) under it, so the
+    lock is never held for the length of a full parse.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._load_lock = threading.Lock()  # первая загрузка — один раз, даже если пришли несколько команд сразу
+        self.header = []
+        self._columns = None
+        self._id_col = None  # Load ID не numericise-им: "00012345" должен остаться строкой
+        self.rows = []
+        self.listeners = []
+        self.loaded = False
+        self._stale = False
+        self._modified = None
+        self._wrote = False
+        self._full_sync_at = 0.0
+        self._reload_lock = threading.Lock()  # одна перезагрузка за раз; event loop его не берёт
+        self._appended = 0  # локальные изменения — чтобы заметить те, что пришли во время reload
+        self._edited = 0
+
+    # --- reads ---
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self._load_lock:
+                if not self.loaded:
+                    self.reload()
+
+    def record(self, i):
+        return dict(zip(self.header, self.rows[i]))
+
+    def records(self):
+        with self.lock:
+            header, rows = self.header, list(self.rows)
+        return [dict(zip(header, row)) for row in rows]
+
+    def column_map(self):
+        """{column name: 1-based column}, rebuilt only when the header changes."""
+        with self.lock:
+            if self._columns is None:
+                self._columns = {name: n + 1 for n, name in enumerate(self.header) if name}
+            return self._columns
+
+    # --- sync with the sheet ---
+
+    def _parse_row(self, values):
+        import gspread
+        values = list(values[:len(self.header)])
+        values += [""] * (len(self.header) - len(values))
+        row = gspread.utils.numericise_all(values)
+        if self._id_col is not None:
+            row[self._id_col] = str(values[self._id_col])
+        return tuple(row)
+
+    def reload(self):
+        import gspread
+        with self._reload_lock:
+            with self.lock:
+                appended, edited = self._appended, self._edited
+            modified = sheet_call(_sheet_modified_time)
+            values = sheet_call(gspread.Worksheet.get_all_values)
+
+            # разбор и индексы — на отдельной копии, без self.lock: на миллионе строк это минута
+            snapshot = LoadStore()
+            snapshot.header = values[0] if values else []
+            snapshot._id_col = snapshot.header.index(LOAD_ID_COLUMN) if LOAD_ID_COLUMN in snapshot.header else None
+            snapshot.rows = [snapshot._parse_row(row) for row in values[1:]]
+            rebuilt = []
+            for listener in self.listeners:
+                fresh = type(listener)()
+                fresh.reset(snapshot)
+                rebuilt.append(fresh)
+
+            with self.lock:
+                if snapshot.header != self.header:
+                    self._columns = None
+                self.header = snapshot.header
+                self._id_col = snapshot._id_col
+                self.rows = snapshot.rows
+                for listener, fresh in zip(self.listeners, rebuilt):
+                    listener.adopt(fresh)
+                self.loaded = True
+                # наши записи, сделанные, пока шла перезагрузка: дописанные строки подберёт
+                # обычный sync (хвост листа), правленые — только следующая полная перезагрузка
+                self._stale = self._edited != edited
+                self._wrote = self._appended != appended
+                self._modified = modified
+                self._full_sync_at = time.monotonic()
+        logger.info("Load store: %d rows loaded", len(snapshot.rows))
+
+    def sync(self):
+        """Дозагружает строки, появившиеся после последней известной, или перечитывает всё при внешних правках."""
+        import gspread
+        if not self.loaded or self._stale:
+            return self.reload()
+
+        modified = sheet_call(_sheet_modified_time)
+        if modified == self._modified:
+            return
+        with self.lock:
+            edited_elsewhere = not self._wrote
+            full_sync_due = time.monotonic() - self._full_sync_at > LOAD_FULL_SYNC_INTERVAL
+        if edited_elsewhere or full_sync_due:
+            return self.reload()
+
+        with self.lock:
+            start = len(self.rows) + 2
+            last_col = gspread.utils.rowcol_to_a1(1, len(self.header)).rstrip("0123456789")
+        fetched = sheet_call(gspread.Worksheet.get_values, f"A{start}:{last_col}")
+        with self.lock:
+            # пока мы ходили в сеть, часть этих строк могла прийти через apply_append
+            for values in fetched[len(self.rows) + 2 - start:]:
+                self._add(self._parse_row(values))
+            self._modified = modified
+            self._wrote = False
+
+    # --- local writes ---
+
+    def _add(self, row):
+        self._appended += 1
+        self.rows.append(row)
+        for listener in self.listeners:
+            listener.add(self, len(self.rows) - 1, row)
+
+    def apply_append(self, rows, response):
+        """Applies rows we just appended to the sheet, using the append response to place them."""
+        start = _updated_start_row(response)
+        with self.lock:
+            self._wrote = True
+            if not self.loaded:
+                return
+            if start != len(self.rows) + 2:
+                # между нами и листом есть строки, которых мы ещё не видели
+                self._stale = True
+                return
+            for values in rows:
+                self._add(self._parse_row([str(v) for v in values]))
+
+    def apply_update(self, row_number, column_name, value):
+        import gspread
+        with self.lock:
+            self._wrote = True
+            i = row_number - 2
+            if not self.loaded or column_name not in self.header or not 0 <= i < len(self.rows):
+                self._stale = True
+                return
+            old = self.rows[i]
+            new = list(old)
+            if column_name == LOAD_ID_COLUMN:
+                new[self._id_col] = str(value)
+            else:
+                new[self.header.index(column_name)] = gspread.utils.numericise_all([str(value)])[0]
+            new = tuple(new)
+            self.rows[i] = new
+            self._edited += 1
+            for listener in self.listeners:
+                listener.replace(self, i, old, new)
+
+    def apply_row(self, row_number, values):
+        """Refreshes one row from values just read from the sheet."""
+        with self.lock:
+            i = row_number - 2
+            if not self.loaded or not 0 <= i < len(self.rows):
+                return
+            old = self.rows[i]
+            new = self._parse_row(values)
+            if new != old:
+                self.rows[i] = new
+                self._edited += 1
+                for listener in self.listeners:
+                    listener.replace(self, i, old, new)
+
+
+load_store = LoadStore()
+
+
+async def sync_load_store(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await run_blocking("load", load_store.sync)  # может обернуться полной перезагрузкой
+    except Exception:
+        logger.exception("Load store sync failed")
+
+
+LOAD_WAIT = float(os.getenv("LOAD_WAIT", "10"))
+_first_load = None
+
+
+def start_first_load():
+    """The first full read of the sheet, shared by warm-up and every handler waiting on it."""
+    global _first_load
+    failed = _first_load is not None and _first_load.done() and (
+        _first_load.cancelled() or _first_load.exception() is not None)
+    if _first_load is None or failed:
+        _first_load = asyncio.ensure_future(run_blocking("load", load_store.ensure_loaded))
+    return _first_load
+
+
+async def loads_ready(update):
+    """
+    True once the load store is loaded. A handler waits up to LOAD_WAIT seconds
+    for the first load; after that it tells the user to come back instead of
+    holding a Sheets slot for the minutes a large sheet takes to read.
+    """
+    if load_store.loaded:
+        return True
+    try:
+        await asyncio.wait_for(asyncio.shield(start_first_load()), LOAD_WAIT)
+        return True
+    except asyncio.TimeoutError:
+        await update.effective_message.reply_text("⏳ Loads are still loading, try again in a minute.")
+    except Exception:
+        logger.exception("First load of the sheet failed")
+        await update.effective_message.reply_text("❌ Could not read the loads sheet, try again later.")
+    return False
+
+
+# === Submission outbox ===
+# A submission is committed to a local SQLite (WAL) outbox and acknowledged
+# right away. The flusher sends pending rows to the sheet with one append_rows
+# per batch. Every load carries a Load ID: rows that were already attempted are
+# checked against the sheet first, so a crash between append_rows and marking
+# them sent does not duplicate loads.
+
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.sqlite3")
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "10"))
+OUTBOX_FLUSH_DELAY = float(os.getenv("OUTBOX_FLUSH_DELAY", "1"))  # собираем соседние сабмиты в один батч
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_KEEP_SENT = 7 * 24 * 3600
+LOAD_ID_COLUMN = "Load ID"
+IMPORT_ID_PREFIX = "im"  # строки bulk import-а; шлёт их только сам импорт, со своим темпом
+
+
+def new_load_id():
+    """64 random bits; on the off chance the sheet already has the ID, draw again."""
+    while True:
+        load_id = secrets.token_hex(8)
+        if load_id not in load_index.positions:  # чтение dict без lock — нам хватает
+            return load_id
+
+
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " load_id TEXT PRIMARY KEY,"
+                " row TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " sent_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (sent_at, created_at)")
+            try:
+                conn.execute("ALTER TABLE outbox ADD COLUMN firestore_sent_at REAL")
+            except sqlite3.OperationalError:
+                pass  # колонка уже есть
+            self._conn = conn
+        return self._conn
+
+    def put(self, load_id, row):
+        with self._lock:
+            self._db().execute(
+                "INSERT OR IGNORE INTO outbox (load_id, row, created_at) VALUES (?, ?, ?)",
+                (load_id, json.dumps(row), time.time()),
+            )
+
+    def put_many(self, entries):
+        """[(load_id, row)] одной транзакцией, в порядке списка; уже известные ID пропускаются."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                db.executemany(
+                    "INSERT OR IGNORE INTO outbox (load_id, row, created_at) VALUES (?, ?, ?)",
+                    [(load_id, json.dumps(row), now + n * 1e-6) for n, (load_id, row) in enumerate(entries)],
+                )
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """Cross-process flush lock: the bot and `main.py import` share the outbox file."""
+        with open(self.path + ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def pending(self, limit, imported=False):
+        """[(load_id, row, attempts)] в порядке поступления — либо сабмиты, либо строки импорта."""
+        with self._lock:
+            cursor = self._db().execute(
+                "SELECT load_id, row, attempts FROM outbox WHERE sent_at IS NULL AND (load_id LIKE ?) = ?"
+                " ORDER BY created_at LIMIT ?",
+                (IMPORT_ID_PREFIX + "%", int(imported), limit),
+            )
+            return [(load_id, json.loads(row), attempts) for load_id, row, attempts in cursor]
+
+    def pending_count(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL").fetchone()[0]
+
+    def mark_attempt(self, load_ids):
+        with self._lock:
+            self._db().executemany("UPDATE outbox SET attempts = attempts + 1 WHERE load_id = ?",
+                                   [(load_id,) for load_id in load_ids])
+
+    def mark_sent(self, load_ids):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.executemany("UPDATE outbox SET sent_at = ? WHERE load_id = ?",
+                           [(now, load_id) for load_id in load_ids])
+            keep_unmirrored = " AND firestore_sent_at IS NOT NULL" if FIRESTORE_MODE != "off" else ""
+            db.execute("DELETE FROM outbox WHERE sent_at < ?" + keep_unmirrored, (now - OUTBOX_KEEP_SENT,))
+
+    def pending_firestore(self, limit):
+        with self._lock:
+            cursor = self._db().execute(
+                "SELECT load_id, row FROM outbox WHERE firestore_sent_at IS NULL ORDER BY created_at LIMIT ?",
+                (limit,),
+            )
+            return [(load_id, json.loads(row)) for load_id, row in cursor]
+
+    def mark_firestore_sent(self, load_ids):
+        now = time.time()
+        with self._lock:
+            self._db().executemany("UPDATE outbox SET firestore_sent_at = ? WHERE load_id = ?",
+                                   [(now, load_id) for load_id in load_ids])
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+outbox = Outbox(OUTBOX_PATH)
+_flush_lock = threading.Lock()
+
+
+def _ensure_load_id_column(sheet):
+    """Добавляет колонку Load ID в заголовок листа, если её ещё нет; возвращает её номер (с 1)."""
+    if LOAD_ID_COLUMN in load_store.header:
+        return load_store.header.index(LOAD_ID_COLUMN) + 1
+    col = len(load_store.header) + 1
+    if sheet.col_count < col:
+        sheet.add_cols(col - sheet.col_count)
+    sheet.update_cell(1, col, LOAD_ID_COLUMN)
+    load_store.reload()
+    return col
+
+
+def flush_outbox_batch(limit=OUTBOX_BATCH_SIZE, imported=False):
+    """
+    Sends one batch of pending submissions (or, with imported=True, bulk import
+    rows) to the sheet. Returns how many rows left the outbox.
+    """
+    import gspread
+    with _flush_lock, outbox.exclusive():
+        batch = outbox.pending(limit, imported)
+        if not batch:
+            return 0
+
+        load_store.ensure_loaded()
+        id_col = sheet_call(_ensure_load_id_column)
+
+        if any(attempts for _, _, attempts in batch):
+            # прошлая попытка могла дойти до таблицы — сверяемся с ней
+            load_store.sync()
+            present = {load_id for load_id, _, _ in batch if load_index.find(load_id) is not None}
+            already_sent = [load_id for load_id, _, _ in batch if load_id in present]
+            if already_sent:
+                outbox.mark_sent(already_sent)
+            batch = [entry for entry in batch if entry[0] not in present]
+            if not batch:
+                return len(already_sent)
+
+        rows = []
+        for load_id, row, _ in batch:
+            row = row + [""] * (id_col - len(row))
+            row[id_col - 1] = load_id
+            rows.append(row)
+
+        load_ids = [load_id for load_id, _, _ in batch]
+        outbox.mark_attempt(load_ids)
+        response = sheet_call(gspread.Worksheet.append_rows, rows)
+        outbox.mark_sent(load_ids)
+        load_store.apply_append(rows, response)
+        return len(rows)
+
+
+async def flush_outbox(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not load_store.loaded:
+            await start_first_load()  # первую загрузку — на её собственном backend'е, не в слоте Sheets
+        while await run_blocking("sheets", flush_outbox_batch):
+            pass
+    except Exception:
+        logger.exception("Outbox flush failed, %d submissions pending", outbox.pending_count())
+    if FIRESTORE_MODE != "off":
+        try:
+            while await flush_outbox_firestore_batch():
+                pass
+        except Exception:
+            logger.exception("Firestore flush failed")
+
+
+# === Firestore load backend ===
+# FIRESTORE_MODE:
+#   off     — Firestore is not used (default);
+#   mirror  — every load is also written to the "loads" collection;
+#   primary — as mirror, and /my_loads and /my_stats read from Firestore.
+# Documents are keyed by Load ID, so re-sending a batch is harmless. Writes go
+# out in WriteBatches of at most 500 operations (the Firestore limit).
+# The queries need composite indexes on (User ID, Date) in the loads collection.
+#
+# Only loads that pass through the outbox are mirrored as they come. Before
+# switching to primary, copy the existing sheet history once:
+#
+#   python main.py firestore-backfill
+#
+# Hand edits of the sheet are not mirrored either; FIRESTORE_RESYNC_INTERVAL
+# (seconds, 0 — off) re-runs the same backfill periodically to pick them up.
+# Rows deleted from the sheet stay in Firestore.
+
+FIRESTORE_MODE = os.getenv("FIRESTORE_MODE", "off")
+FIRESTORE_COLLECTION = os.getenv("FIRESTORE_COLLECTION", "loads")
+FIRESTORE_BATCH_LIMIT = 500
+FIRESTORE_RESYNC_INTERVAL = int(os.getenv("FIRESTORE_RESYNC_INTERVAL", "0"))
+
+# позиции полей в строке листа (см. finalize_submission)
+_FIRESTORE_FIELDS = {
+    "Date": 0, "Pickup ZIP": 1, "Delivery ZIP": 2, "Total Miles": 5, "Rate": 6, "RPM Total": 8,
+    "Trailer": 9, "User": 10, "Comment": 12, "Posted By": 13, "User ID": 14,
+}
+
+
+def firestore_doc(row, load_id):
+    """Document for a row in sheet layout: an outbox row or a load store row."""
+    doc = {name: row[n] if n < len(row) else "" for name, n in _FIRESTORE_FIELDS.items()}
+    doc["Pickup ZIP"], doc["Delivery ZIP"] = zip_text(doc["Pickup ZIP"]), zip_text(doc["Delivery ZIP"])
+    doc["RPM Total"] = to_float(doc["RPM Total"], decimal_comma=True)
+    doc["User ID"] = str(doc["User ID"])
+    doc["Load ID"] = load_id
+    return doc
+
+
+async def firestore_write(docs):
+    """Upserts {load_id: fields}, at most FIRESTORE_BATCH_LIMIT writes per commit."""
+    db = get_async_db()
+    collection = db.collection(FIRESTORE_COLLECTION)
+    items = list(docs.items())
+    for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for load_id, fields in items[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(collection.document(load_id), fields, merge=True)
+        backend_calls.inc("firestore", "batch_commit")
+        await run_async("firestore", batch.commit())
+
+
+async def firestore_backfill():
+    """Upserts every sheet row that has a Load ID, FIRESTORE_BATCH_LIMIT per commit. Returns the count."""
+    await run_blocking("load", load_store.ensure_loaded)
+    with load_store.lock:
+        header, rows, id_col = load_store.header, load_store.rows, load_store._id_col
+    if id_col is None:
+        return 0
+    if [header.index(name) if name in header else None for name in _FIRESTORE_FIELDS] != list(_FIRESTORE_FIELDS.values()):
+        raise RuntimeError("Sheet columns differ from the layout firestore_doc expects")
+    count = 0
+    for start in range(0, len(rows), FIRESTORE_BATCH_LIMIT):
+        # reload подменяет список целиком, append только дописывает — срез остаётся согласованным
+        docs = {row[id_col]: firestore_doc(row, row[id_col])
+                for row in rows[start:start + FIRESTORE_BATCH_LIMIT] if row[id_col]}
+        if docs:
+            await firestore_write(docs)
+            count += len(docs)
+    logger.info("Firestore backfill: %d loads written", count)
+    return count
+
+
+async def firestore_resync(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await firestore_backfill()
+    except Exception:
+        logger.exception("Firestore resync failed")
+
+
+async def flush_outbox_firestore_batch():
+    pending = await run_blocking("outbox", outbox.pending_firestore, FIRESTORE_BATCH_LIMIT)
+    if not pending:
+        return 0
+    await firestore_write({load_id: firestore_doc(row, load_id) for load_id, row in pending})
+    await run_blocking("outbox", outbox.mark_firestore_sent, [load_id for load_id, _ in pending])
+    return len(pending)
+
+
+async def firestore_update(load_id, changes):
+    """Mirrors an edit of a sheet row; failures are logged, the sheet stays the source of truth."""
+    if FIRESTORE_MODE == "off" or not load_id:
+        return
+    fields = dict(changes)
+    if "RPM Total" in fields:
+        fields["RPM Total"] = to_float(fields["RPM Total"], decimal_comma=True)
+    for name in ("Total Miles", "Rate"):
+        if name in fields:
+            fields[name] = to_float(fields[name])
+    try:
+        await firestore_write({str(load_id): fields})
+    except Exception:
+        logger.exception("Firestore update of %s failed", load_id)
+
+
+def _firestore_user_query(user_id):
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    return get_async_db().collection(FIRESTORE_COLLECTION).where(filter=FieldFilter("User ID", "==", str(user_id)))
+
+
+async def firestore_latest_loads(user_id, n):
+    from google.cloud import firestore
+
+    query = _firestore_user_query(user_id).order_by("Date", direction=firestore.Query.DESCENDING).limit(n)
+    backend_calls.inc("firestore", "query")
+    return [snapshot.to_dict() async for snapshot in query.stream()]
+
+
+async def firestore_loads_between(user_id, start, end):
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    query = (_firestore_user_query(user_id)
+             .where(filter=FieldFilter("Date", ">=", start.isoformat()))
+             .where(filter=FieldFilter("Date", "<=", end.isoformat())))
+    backend_calls.inc("firestore", "query")
+    return [snapshot.to_dict() async for snapshot in query.stream()]
+
+
+def summarize_loads(docs):
+    """Тот же кортеж, что LoadTable.summary(), но по документам Firestore."""
+    miles = rate = rpm = 0.0
+    rpm_count = 0
+    for doc in docs:
+        miles += to_float(doc.get("Total Miles", "")) or 0.0
+        rate += to_float(doc.get("Rate", "")) or 0.0
+        value = to_float(doc.get("RPM Total", ""), decimal_comma=True)
+        if value is not None:
+            rpm += value
+            rpm_count += 1
+    return len(docs), miles, rate, rpm, rpm_count
+
 
 def classify_distance(miles):
     if miles < 500:
@@ -58,42 +1061,453 @@ def classify_distance(miles):
         return "Medium"
     return "Long"
 
-def load_data():
-    sheet = get_sheet()
-    data = sheet.get_all_records()
-    df = pd.DataFrame(data)
-    df['Date'] = pd.to_datetime(df['Date'], errors='coerce').dt.date
-    df['Total Miles'] = pd.to_numeric(df['Total Miles'], errors='coerce')
-    df['RPM Total'] = pd.to_numeric(df['RPM Total'].astype(str).str.replace(',', '.'), errors='coerce')
-    df['Length Category'] = df['Total Miles'].apply(classify_distance)
+LENGTH_CATEGORIES = ["Short", "Medium", "Long"]
+CATEGORICAL_COLUMNS = ["Trailer", "User ID", "User", "Posted By", "Pickup ZIP", "Delivery ZIP"]
+
+def load_data(columns=None):
+    """
+    Typed DataFrame of the load store: one column list per wanted column straight
+    from the stored rows, numbers coerced once, Length Category binned with
+    np.select (blank miles land in "Long", like classify_distance), and
+    low-cardinality text columns stored as categoricals.
+    """
+    import numpy as np
+    import pandas as pd
+
+    load_store.ensure_loaded()
+    with load_store.lock:
+        header = list(load_store.header)
+        rows = list(load_store.rows)
+
+    wanted = {name: header.index(name) for name in (columns or header) if name and name in header}
+    df = pd.DataFrame({name: [row[n] for row in rows] for name, n in wanted.items()})
+
+    if "Date" in df:
+        df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+    for name in ("Total Miles", "Rate"):
+        if name in df:
+            df[name] = pd.to_numeric(df[name], errors="coerce")
+    if "RPM Total" in df:
+        rpm = pd.to_numeric(df["RPM Total"], errors="coerce")
+        # десятичная запятая — только у тех немногих значений, что не распарсились сразу
+        raw = df.loc[rpm.isna(), "RPM Total"]
+        if len(raw):
+            rpm[raw.index] = pd.to_numeric(raw.astype(str).str.replace(",", ".", regex=False), errors="coerce")
+        df["RPM Total"] = rpm
+    if "Total Miles" in df:
+        miles = df["Total Miles"].to_numpy()
+        df["Length Category"] = pd.Categorical(
+            np.select([miles < 500, miles <= 1000], LENGTH_CATEGORIES[:2], LENGTH_CATEGORIES[2]),
+            categories=LENGTH_CATEGORIES,
+        )
+    for name in CATEGORICAL_COLUMNS:
+        if name in df:
+            df[name] = df[name].astype(str).astype("category")
     return df
 
-def generate_stats_message(period_label, df):
+def parse_load_date(value):
+    text = str(value).strip()
+    for fmt in ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%m/%d/%Y", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+def to_float(value, decimal_comma=False):
+    """float или None — как pd.to_numeric(errors='coerce'), только без pandas."""
+    text = str(value).strip()
+    if decimal_comma:
+        text = text.replace(",", ".")
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    return None if number != number else number
+
+
+# === Daily rollups for /stats ===
+# Per-day buckets keyed by (trailer, length category), kept current by the load
+# store. A period answer only sums the buckets of the days it covers, so /stats
+# costs the same whatever the size of the sheet.
+
+class DailyRollups:
+    # bucket: [loads, rpm sum, loads with rpm, miles sum, rate sum]
+
+    def __init__(self):
+        self.days = []      # отсортированные дни, для bisect
+        self.buckets = {}   # day -> {(trailer, category): bucket}
+        self.version = 0    # растёт при каждом изменении, ключ кэша /stats
+
+    def reset(self, store):
+        self.days = []
+        self.buckets = {}
+        for row in store.rows:
+            self._apply(store.header, row, 1)
+        self.version += 1
+
+    def adopt(self, fresh):
+        self.days, self.buckets = fresh.days, fresh.buckets
+        self.version += 1  # не fresh.version: кэш /stats помнит прежние версии
+
+    def add(self, store, i, row):
+        self._apply(store.header, row, 1)
+        self.version += 1
+
+    def replace(self, store, i, old, new):
+        self._apply(store.header, old, -1)
+        self._apply(store.header, new, 1)
+        self.version += 1
+
+    def _apply(self, header, row, sign):
+        record = dict(zip(header, row))
+        day = parse_load_date(record.get("Date", ""))
+        if day is None:
+            return
+        miles = to_float(record.get("Total Miles", ""))
+        rate = to_float(record.get("Rate", ""))
+        rpm = to_float(record.get("RPM Total", ""), decimal_comma=True)
+        category = classify_distance(miles if miles is not None else float("nan"))
+        key = (record.get("Trailer", ""), category)
+
+        if day not in self.buckets:
+            bisect.insort(self.days, day)
+            self.buckets[day] = {}
+        day_buckets = self.buckets[day]
+        bucket = day_buckets.setdefault(key, [0, 0.0, 0, 0.0, 0.0])
+        bucket[0] += sign
+        if rpm is not None:
+            bucket[1] += sign * rpm
+            bucket[2] += sign
+        bucket[3] += sign * (miles or 0.0)
+        bucket[4] += sign * (rate or 0.0)
+
+        if bucket[0] <= 0:
+            del day_buckets[key]
+            if not day_buckets:
+                del self.buckets[day]
+                self.days.remove(day)
+
+    def totals(self, since):
+        """Sums buckets of all days from `since` on: {(trailer, category): bucket}."""
+        result = {}
+        with load_store.lock:
+            for day in self.days[bisect.bisect_left(self.days, since):]:
+                for key, bucket in self.buckets[day].items():
+                    total = result.setdefault(key, [0, 0.0, 0, 0.0, 0.0])
+                    for n, value in enumerate(bucket):
+                        total[n] += value
+        return result
+
+
+stats_rollups = DailyRollups()
+load_store.listeners.append(stats_rollups)
+
+
+def _format_avg_rpm(bucket):
+    if not bucket[2]:
+        return "—"
+    return f"{round(bucket[1] / bucket[2], 2):.2f}"
+
+def generate_stats_message(period_label, totals):
     lines = [f"\U0001F4CA Load Stats — {period_label}\n"]
-    avg_by_trailer = df.groupby("Trailer")["RPM Total"].mean().round(2)
+
+    by_trailer = {}
+    for (trailer, _), bucket in totals.items():
+        total = by_trailer.setdefault(trailer, [0, 0.0, 0, 0.0, 0.0])
+        for n, value in enumerate(bucket):
+            total[n] += value
+
     lines.append("\U0001F69A Average RPM by Trailer Type:")
-    for trailer, avg in avg_by_trailer.items():
-        avg_display = f"{avg:.2f}" if not pd.isna(avg) else "—"
-        lines.append(f"• {trailer}: Total — {avg_display}")
+    for trailer in sorted(by_trailer, key=str):
+        lines.append(f"• {trailer}: Total — {_format_avg_rpm(by_trailer[trailer])}")
 
     lines.append("\n\U0001F4DD RPM by Load Length & Trailer Type:")
     lines.append("Length categories:\n• Short < 500 mi\n• Medium = 500 to 1000 mi\n• Long > 1000 mi\n")
 
     for category in ["Short", "Medium", "Long"]:
         lines.append(f"{category} Loads:")
-        cat_df = df[df["Length Category"] == category]
-        for trailer, avg in cat_df.groupby("Trailer")["RPM Total"].mean().round(2).items():
-            avg_display = f"{avg:.2f}" if not pd.isna(avg) else "—"
-            lines.append(f"  • {trailer}: Total — {avg_display}")
+        trailers = sorted((t for t, c in totals if c == category), key=str)
+        for trailer in trailers:
+            lines.append(f"  • {trailer}: Total — {_format_avg_rpm(totals[(trailer, category)])}")
         lines.append("")
 
     return "\n".join(lines)
 
-def generate_my_stats_message(label, df):
-    total_loads = len(df)
-    total_miles = int(df['Total Miles'].sum())
-    total_rate = int(df['Rate'].sum())
-    avg_rpm = round(df['RPM Total'].mean(), 2) if not df['RPM Total'].isna().all() else "—"
+
+# Rendered /stats text per period, tagged with the rollups version it was built
+# from; a tap only recomputes after a submission or edit has changed the data.
+# Concurrent taps for the same period and version share one computation.
+
+_stats_cache = {}     # label -> (since, version, text)
+_stats_inflight = {}  # (label, since, version) -> future
+stats_cache_lookups = MetricCounter("rateguard_stats_cache_total", "/stats render cache lookups", ("result",))
+
+
+def _render_stats(label, since):
+    with load_store.lock:
+        version = stats_rollups.version
+        totals = stats_rollups.totals(since)
+    return version, generate_stats_message(label, totals)
+
+
+async def cached_stats_message(label, since):
+    version = stats_rollups.version
+    cached = _stats_cache.get(label)
+    if cached is not None and cached[:2] == (since, version):
+        stats_cache_lookups.inc("hit")
+        return cached[2]
+
+    key = (label, since, version)
+    future = _stats_inflight.get(key)
+    if future is not None:
+        stats_cache_lookups.inc("coalesced")
+        return (await asyncio.shield(future))[1]
+
+    stats_cache_lookups.inc("miss")
+    loop = asyncio.get_running_loop()
+    future = _stats_inflight[key] = loop.run_in_executor(_io_executor, _render_stats, label, since)
+    try:
+        version, text = await asyncio.shield(future)
+    finally:
+        del _stats_inflight[key]
+    cached = _stats_cache.get(label)
+    if cached is None or cached[:2] != (since, version) and cached[1] <= version:
+        _stats_cache[label] = (since, version, text)
+    return text
+
+# === Columnar load table for /my_stats and /my_loads ===
+# Typed arrays with one slot per sheet row, trailer and user stored as codes,
+# and per user a sorted array of (day << 32 | position) keys. "Last N loads of
+# user X" is a slice from the end, "user X between two dates" is two bisects.
+
+class LoadTable:
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, store):
+        self.day = array("i")       # date.toordinal(), 0 — нет даты
+        self.miles = array("d")
+        self.rate = array("d")
+        self.rpm = array("d")
+        self.trailer = array("H")
+        self.user = array("I")
+        self.trailer_names = []
+        self.user_ids = []
+        self._trailer_codes = {}
+        self._user_codes = {}
+        self.by_user = {}           # user code -> array("q") ключей (day << 32 | pos)
+        if store is not None:
+            for i, row in enumerate(store.rows):
+                self.add(store, i, row)
+
+    def adopt(self, fresh):
+        self.__dict__.update(fresh.__dict__)
+
+    @staticmethod
+    def _code(value, names, codes):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def _columns(self, header, row):
+        record = dict(zip(header, row))
+        day = parse_load_date(record.get("Date", ""))
+        numbers = [
+            to_float(record.get("Total Miles", "")),
+            to_float(record.get("Rate", "")),
+            to_float(record.get("RPM Total", ""), decimal_comma=True),
+        ]
+        return (
+            day.toordinal() if day else 0,
+            *(float("nan") if number is None else number for number in numbers),
+            self._code(str(record.get("Trailer", "")), self.trailer_names, self._trailer_codes),
+            self._code(str(record.get("User ID", "")), self.user_ids, self._user_codes),
+        )
+
+    def add(self, store, i, row):
+        day, miles, rate, rpm, trailer, user = self._columns(store.header, row)
+        self.day.append(day)
+        self.miles.append(miles)
+        self.rate.append(rate)
+        self.rpm.append(rpm)
+        self.trailer.append(trailer)
+        self.user.append(user)
+        bisect.insort(self.by_user.setdefault(user, array("q")), day << 32 | i)
+
+    def replace(self, store, i, old, new):
+        day, miles, rate, rpm, trailer, user = self._columns(store.header, new)
+        if (day, user) != (self.day[i], self.user[i]):
+            keys = self.by_user[self.user[i]]
+            del keys[bisect.bisect_left(keys, self.day[i] << 32 | i)]
+            bisect.insort(self.by_user.setdefault(user, array("q")), day << 32 | i)
+        self.day[i] = day
+        self.miles[i] = miles
+        self.rate[i] = rate
+        self.rpm[i] = rpm
+        self.trailer[i] = trailer
+        self.user[i] = user
+
+    def latest(self, user_id, n):
+        """Позиции последних n датированных грузов пользователя, новые первыми."""
+        with load_store.lock:
+            keys = self.by_user.get(self._user_codes.get(str(user_id)), ())
+            first = bisect.bisect_left(keys, 1 << 32)
+            return [key & 0xFFFFFFFF for key in reversed(keys[max(first, len(keys) - n):])]
+
+    def between(self, user_id, start, end):
+        """Позиции грузов пользователя с датой в [start, end]."""
+        with load_store.lock:
+            keys = self.by_user.get(self._user_codes.get(str(user_id)), ())
+            lo = bisect.bisect_left(keys, start.toordinal() << 32)
+            hi = bisect.bisect_left(keys, (end.toordinal() + 1) << 32)
+            return [key & 0xFFFFFFFF for key in keys[lo:hi]]
+
+    def summary(self, positions):
+        """(loads, miles sum, rate sum, rpm sum, loads with rpm) — NaN пропускаются, как в pandas."""
+        miles = rate = rpm = 0.0
+        rpm_count = 0
+        with load_store.lock:
+            for i in positions:
+                if self.miles[i] == self.miles[i]:
+                    miles += self.miles[i]
+                if self.rate[i] == self.rate[i]:
+                    rate += self.rate[i]
+                if self.rpm[i] == self.rpm[i]:
+                    rpm += self.rpm[i]
+                    rpm_count += 1
+        return len(positions), miles, rate, rpm, rpm_count
+
+
+load_table = LoadTable()
+load_store.listeners.append(load_table)
+
+
+# === Load ID index ===
+# Load ID -> position in load_store.rows, kept by the store listeners, so the
+# edit flow finds a load without scanning. The sheet can still shift under us
+# between syncs (rows inserted or deleted by hand); locate_load checks the
+# position with one row fetch and reloads the store when it does not match.
+
+class LoadIndex:
+    def __init__(self):
+        self.positions = {}
+        self.duplicates = set()  # ID встречается в нескольких строках (скопировали руками)
+
+    def reset(self, store):
+        self.positions = {}
+        self.duplicates = set()
+        if store._id_col is None:
+            return
+        for i, row in enumerate(store.rows):
+            self.add(store, i, row)
+        if self.duplicates:
+            logger.warning("%d Load IDs appear in more than one row, those loads can't be edited",
+                           len(self.duplicates))
+
+    def adopt(self, fresh):
+        self.positions, self.duplicates = fresh.positions, fresh.duplicates
+
+    def add(self, store, i, row):
+        if store._id_col is None or not row[store._id_col]:
+            return
+        load_id = row[store._id_col]
+        if self.positions.setdefault(load_id, i) != i:
+            self.duplicates.add(load_id)
+
+    def replace(self, store, i, old, new):
+        if store._id_col is None or old[store._id_col] == new[store._id_col]:
+            return
+        if self.positions.get(old[store._id_col]) == i:
+            del self.positions[old[store._id_col]]
+        self.add(store, i, new)
+
+    def find(self, load_id):
+        with load_store.lock:
+            return self.positions.get(load_id)
+
+
+load_index = LoadIndex()
+load_store.listeners.append(load_index)
+
+
+def locate_load(load_id):
+    """Sheet row number of a load, confirmed against the sheet; None if it is gone or ambiguous."""
+    import gspread
+    position = load_index.find(load_id)
+    if position is None or load_id in load_index.duplicates:
+        return None
+    values = sheet_call(gspread.Worksheet.row_values, position + 2)
+    with load_store.lock:
+        id_col = load_store._id_col
+    if len(values) > id_col and values[id_col] == load_id:
+        load_store.apply_row(position + 2, values)  # заодно свежие значения для меню
+        return position + 2
+    # строки сдвинули руками — перечитываем лист, индекс перестроится
+    logger.info("Load %s is not where the index says, reloading the sheet", load_id)
+    load_store.reload()
+    position = load_index.find(load_id)
+    return None if position is None or load_id in load_index.duplicates else position + 2
+
+
+def confirm_load_row(load_id, row_number, user_id):
+    """
+    Row number to write an edit to, re-read from the sheet right before the write;
+    None if the load is no longer there. Loads without an ID are checked by owner,
+    date and pickup ZIP against the row the menu was built from.
+    """
+    import gspread
+    if load_id:
+        return locate_load(load_id)
+    values = sheet_call(gspread.Worksheet.row_values, row_number)
+    with load_store.lock:
+        i = row_number - 2
+        if not 0 <= i < len(load_store.rows):
+            return None
+        cached = load_store.record(i)
+        current = dict(zip(load_store.header, load_store._parse_row(values)))
+    keys = ("User ID", "Date", "Pickup ZIP")
+    if str(cached.get("User ID", "")) != user_id or any(str(current.get(k, "")) != str(cached.get(k, "")) for k in keys):
+        return None
+    return row_number
+
+
+def backfill_load_ids():
+    """Gives rows added before the Load ID column their IDs, in one batch_update. Returns how many."""
+    import gspread
+    with _flush_lock:
+        load_store.sync()
+        col = sheet_call(_ensure_load_id_column)
+        with load_store.lock:
+            missing = [i for i, row in enumerate(load_store.rows)
+                       if not row[col - 1] and any(value != "" for value in row)]
+        if not missing:
+            return 0
+        ids = {i: new_load_id() for i in missing}
+        runs = []  # подряд идущие строки — одним диапазоном
+        for i in missing:
+            if runs and runs[-1][1] == i - 1:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        sheet_call(gspread.Worksheet.batch_update, [
+            {"range": f"{gspread.utils.rowcol_to_a1(first + 2, col)}:{gspread.utils.rowcol_to_a1(last + 2, col)}",
+             "values": [[ids[i]] for i in range(first, last + 1)]}
+            for first, last in runs
+        ], value_input_option="RAW")
+        for i, load_id in ids.items():
+            load_store.apply_update(i + 2, LOAD_ID_COLUMN, load_id)
+        logger.info("Backfilled %d load IDs", len(ids))
+        return len(ids)
+
+
+def generate_my_stats_message(label, summary):
+    total_loads, miles, rate, rpm_sum, rpm_count = summary
+    total_miles = int(miles)
+    total_rate = int(rate)
+    avg_rpm = round(rpm_sum / rpm_count, 2) if rpm_count else "—"
 
     return (
         f"📊 {label}\n"
@@ -103,6 +1517,156 @@ def generate_my_stats_message(label, df):
         f"📈 Average RPM: {avg_rpm}"
     )
 
+# === Deferred message cleanup ===
+# Handlers never wait for cosmetic deletions. schedule_delete() records the
+# message per chat and a JobQueue job removes everything that is due in that
+# chat with one deleteMessages call (per-message deletes on PTB versions
+# without Bot.delete_messages).
+
+DELETE_COALESCE_SECONDS = 0.5
+_pending_deletions = {}  # chat_id -> [(due, message_id)]
+_deletion_jobs = {}      # chat_id -> {due запланированных job'ов}
+
+
+def schedule_delete(context, chat_id, message_ids, delay=0):
+    due = time.monotonic() + delay
+    _pending_deletions.setdefault(chat_id, []).extend((due, message_id) for message_id in message_ids)
+
+    scheduled = _deletion_jobs.setdefault(chat_id, set())
+    # job, который сработает чуть позже, заберёт и эти сообщения
+    if any(due <= other <= due + DELETE_COALESCE_SECONDS for other in scheduled):
+        return
+    scheduled.add(due)
+    context.job_queue.run_once(_delete_due_messages, delay, data=due, chat_id=chat_id)
+
+
+async def delete_messages(bot, chat_id, message_ids):
+    for start in range(0, len(message_ids), 100):  # deleteMessages берёт до 100 id за раз
+        try:
+            await bot.delete_messages(chat_id, message_ids[start:start + 100])
+        except TelegramError as e:
+            logger.debug("deleteMessages in %s failed: %s", chat_id, e)
+
+
+async def _delete_due_messages(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.chat_id
+    scheduled = _deletion_jobs.get(chat_id, set())
+    scheduled.discard(context.job.data)
+
+    now = time.monotonic() + DELETE_COALESCE_SECONDS
+    pending = _pending_deletions.pop(chat_id, [])
+    due_ids = [message_id for due, message_id in pending if due <= now]
+    rest = [(due, message_id) for due, message_id in pending if due > now]
+    if rest:
+        _pending_deletions[chat_id] = rest
+    if not scheduled:
+        _deletion_jobs.pop(chat_id, None)
+
+    if due_ids:
+        await delete_messages(context.bot, chat_id, due_ids)
+
+
+# === Channel publisher ===
+# Load posts go to every chat in PUBLISH_CHAT_IDS through one queue and worker
+# per chat, so delivery within a chat stays in order while chats are served in
+# parallel. Token buckets keep us under Telegram's flood limits (about 30
+# messages/s overall, 20/min per group or channel); RetryAfter pauses the chat
+# and the message is resent. finalize_submission only enqueues.
+
+PUBLISH_CHAT_IDS = [chat.strip() for chat in os.getenv("PUBLISH_CHAT_IDS", "@rateguard,-1002235875053").split(",")
+                    if chat.strip()]
+PUBLISH_GLOBAL_RATE = float(os.getenv("PUBLISH_GLOBAL_RATE", "25"))      # сообщений в секунду на бота
+PUBLISH_CHAT_RATE = float(os.getenv("PUBLISH_CHAT_RATE", str(20 / 60)))  # сообщений в секунду на чат
+PUBLISH_CHAT_BURST = int(os.getenv("PUBLISH_CHAT_BURST", "3"))
+PUBLISH_RETRIES = 5
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Telegram asked us to wait: nothing goes out through this bucket for `seconds`."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Publisher:
+    def __init__(self):
+        self.global_bucket = TokenBucket(PUBLISH_GLOBAL_RATE, PUBLISH_GLOBAL_RATE)
+        self._queues = {}
+        self._workers = {}
+
+    def publish(self, bot, text, chat_ids=None):
+        for chat_id in chat_ids or PUBLISH_CHAT_IDS:
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = asyncio.Queue()
+                self._workers[chat_id] = asyncio.get_running_loop().create_task(self._worker(bot, chat_id, queue))
+            queue.put_nowait(text)
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def _worker(self, bot, chat_id, queue):
+        bucket = TokenBucket(PUBLISH_CHAT_RATE, PUBLISH_CHAT_BURST)
+        while True:
+            text = await queue.get()
+            try:
+                await self._send(bot, chat_id, text, bucket)
+            except Exception:
+                logger.exception("Publishing to %s failed", chat_id)
+            finally:
+                queue.task_done()
+
+    async def _send(self, bot, chat_id, text, bucket):
+        for attempt in range(PUBLISH_RETRIES):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning("Flood control in %s, retrying in %.0fs", chat_id, seconds)
+                backend_retries.inc("telegram")
+                bucket.pause(seconds)
+            except (TimedOut, NetworkError):
+                backend_retries.inc("telegram")
+                await asyncio.sleep(2 ** attempt)
+        logger.error("Giving up on a post to %s after %d attempts", chat_id, PUBLISH_RETRIES)
+
+    async def drain(self, timeout=30):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Publisher stopped with %d posts still queued", self.queue_depth())
+        for worker in self._workers.values():
+            worker.cancel()
+        self._queues.clear()
+        self._workers.clear()
+
+
+publisher = Publisher()
+
+
 # === /submit ===
 
 # === START SUBMIT FLOW ===
@@ -115,22 +1679,38 @@ submit_step_texts = [
     "🚛 *Step 5/6* — Choose trailer type:",
     "💬 *Step 6/6* — Add comment (or press 'Skip')"
 ]
-submit_current_messages = {}  # для отслеживания сообщения с кнопками
+def _submit_step(update, context):
+    return submit_states[context.user_data.get("submit_step", 0)]
 
+@instrumented()
 async def submit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     context.user_data["submit_step"] = 0
     await send_submit_step(update.effective_chat.id, context)
     return PICKUP
 
-async def send_submit_step(chat_id, context: ContextTypes.DEFAULT_TYPE):
+async def send_submit_step(chat_id, context: ContextTypes.DEFAULT_TYPE, note=None, keep=None):
     step = context.user_data.get("submit_step", 0)
     text = submit_step_texts[step]
 
     # Кнопки отмены
     buttons = [[InlineKeyboardButton("❌ Cancel", callback_data="cancel")]]
 
-    if step == 4:  # трейлеры
+    if step == 2:  # мили — подсказка по центроидам ZIP
+        try:
+            estimate = await suggest_lane_miles_async(context.user_data["pickup_zip"], context.user_data["delivery_zip"])
+        except Exception:
+            logger.exception("Lane miles estimate failed, asking without it")
+            estimate = None
+        context.user_data["miles_estimate"] = estimate
+        if estimate is not None:
+            text += f"\n_Estimated: ~{estimate} mi_"
+            buttons.insert(0, [InlineKeyboardButton(f"📏 Use {estimate} mi", callback_data=f"miles_{estimate}")])
+        if note:
+            text = f"{note}\n\n{text}"
+        if keep:
+            buttons.insert(0, [InlineKeyboardButton(f"✅ Keep {keep} mi", callback_data=f"miles_{keep}")])
+    elif step == 4:  # трейлеры
         trailer_row1 = [
             InlineKeyboardButton("Dry Van", callback_data="Dry Van"),
             InlineKeyboardButton("Reefer", callback_data="Reefer"),
@@ -147,8 +1727,9 @@ async def send_submit_step(chat_id, context: ContextTypes.DEFAULT_TYPE):
         buttons[0].insert(0, InlineKeyboardButton("➡️ Skip", callback_data="skip"))
 
     msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode="Markdown")
-    submit_current_messages[chat_id] = msg.message_id
+    submit_current_messages.set(chat_id, msg.message_id)
 
+@instrumented(step=_submit_step)
 async def handle_submit_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_input = update.message.text.strip()
@@ -158,15 +1739,23 @@ async def handle_submit_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     field = submit_states[step]
     context.user_data[field] = user_input
 
-    # Удаление старого сообщения бота
-    if chat_id in submit_current_messages:
-        await context.bot.delete_message(chat_id, submit_current_messages[chat_id])
-    # Удаляем последнее сообщение пользователя
-    if "last_user_message_id" in context.user_data:
+    # Удаляем старое сообщение бота и ответ пользователя одним запросом
+    to_delete = [context.user_data["last_user_message_id"]]
+    step_message_id = submit_current_messages.get(chat_id)
+    if step_message_id is not None:
+        to_delete.insert(0, step_message_id)
+    schedule_delete(context, chat_id, to_delete)
+
+    if field == "total_miles":
         try:
-            await context.bot.delete_message(chat_id, context.user_data["last_user_message_id"])
-        except:
-            pass  # Игнорируем, если нельзя удалить
+            miles = parse_amount(user_input)
+        except ValueError:
+            miles = None
+        note = check_typed_miles(miles, context.user_data.get("miles_estimate"))
+        if note:
+            keep = f"{miles:g}" if note is not MILES_NOT_A_NUMBER else None
+            await send_submit_step(chat_id, context, note, keep)
+            return step
 
     step += 1
     if step < len(submit_states):
@@ -174,9 +1763,11 @@ async def handle_submit_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         await send_submit_step(chat_id, context)
         return step
     else:
+        submit_current_messages.pop(chat_id)
         await finalize_submission(update, context)
         return ConversationHandler.END
 
+@instrumented(step=_submit_step)
 async def handle_submit_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     chat_id = query.message.chat.id
@@ -184,16 +1775,18 @@ async def handle_submit_callback(update: Update, context: ContextTypes.DEFAULT_T
     field = submit_states[step]
 
     await query.answer()
-    await context.bot.delete_message(chat_id, query.message.message_id)
+    schedule_delete(context, chat_id, [query.message.message_id])
 
     if query.data == "cancel":
         msg = await context.bot.send_message(chat_id=chat_id, text="❌ Submission canceled.")
-        await asyncio.sleep(5)
-        await context.bot.delete_message(chat_id, msg.message_id)
+        schedule_delete(context, chat_id, [msg.message_id], 5)
         context.user_data.clear()  # очищаем данные
+        submit_current_messages.pop(chat_id)
         return ConversationHandler.END  # завершаем сценарий
     if query.data == "skip" and field == "comment":
         context.user_data[field] = ""
+    elif field == "total_miles" and query.data.startswith("miles_"):
+        context.user_data[field] = query.data[len("miles_"):]
     else:
         context.user_data[field] = query.data
 
@@ -203,34 +1796,40 @@ async def handle_submit_callback(update: Update, context: ContextTypes.DEFAULT_T
         await send_submit_step(chat_id, context)
         return step
     else:
+        submit_current_messages.pop(chat_id)
         await finalize_submission(update, context)
         return ConversationHandler.END
 
-async def finalize_submission(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    username = f"@{user.username}" if user.username else user.full_name
-    user_id = str(user.id)
-    data = context.user_data
+MILES_NOT_A_NUMBER = "❗ Miles must be a number, e.g. 742."
 
-    # Конвертация
-    try:
-        total = float(str(data["total_miles"]).replace("$", ""))
-        rate = float(str(data["rate"]).replace("$", ""))
-    except ValueError:
-        msg = await update.effective_message.reply_text("❌ Submission failed. Invalid numbers.")
-        await context.bot.delete_message(update.effective_chat.id, msg.message_id, delay=5)
-        return
 
-    date = datetime.now().strftime("%Y-%m-%d")
-    pickup_city, pickup_state = resolve_location(data["pickup_zip"])
-    delivery_city, delivery_state = resolve_location(data["delivery_zip"])
-    pickup = f"{pickup_city}, {pickup_state}" if pickup_city else pickup_state
-    delivery = f"{delivery_city}, {delivery_state}" if delivery_city else delivery_state
-    rpm_total = format(rate / total, '.2f') if total else ""
+def check_typed_miles(miles, estimate):
+    """None if typed miles are fine, else the note to show above step 3 again."""
+    if miles is None or miles <= 0:
+        return MILES_NOT_A_NUMBER
+    if estimate is not None and miles_outside_estimate(miles, estimate):
+        return f"⚠️ {miles:g} mi looks off for this lane (estimated ~{estimate} mi). Check the number or confirm it."
+    return None
+
+
+def parse_amount(value):
+    """Miles or dollars as typed ("$1,200" -> 1200.0); ValueError if it is not a number."""
+    number = to_float(str(value).replace("$", "").replace(",", ""))
+    if number is None:
+        raise ValueError(f"Not a number: {value!r}")
+    return number
+
+
+def parse_submission_numbers(data):
+    """(total miles, rate) as floats; ValueError if either is not a number."""
+    return parse_amount(data["total_miles"]), parse_amount(data["rate"])
 
-    sheet = get_sheet()
-    sheet.append_row([
-        date,
+
+def build_load_row(data, total, rate, username, user_id, day):
+    """Sheet row of a submission, RPM Total included (also used by the bulk import)."""
+    rpm_total = format(rate / total, '.2f') if total else ""
+    return [
+        day,
         data["pickup_zip"],
         data["delivery_zip"],
         "", "",
@@ -238,13 +1837,51 @@ async def finalize_submission(update: Update, context: ContextTypes.DEFAULT_TYPE
         rate,
         "",
         rpm_total,
-        data["trailer"],
+        data.get("trailer", ""),
         username,
         "",
         data.get("comment", ""),
         username,
         user_id
-    ])
+    ]
+
+
+async def finalize_submission(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    username = f"@{user.username}" if user.username else user.full_name
+    user_id = str(user.id)
+    data = context.user_data
+
+    # Конвертация
+    try:
+        total, rate = parse_submission_numbers(data)
+    except ValueError:
+        msg = await update.effective_message.reply_text("❌ Submission failed. Invalid numbers.")
+        schedule_delete(context, update.effective_chat.id, [msg.message_id], 5)
+        return
+
+    date = datetime.now().strftime("%Y-%m-%d")
+    row = build_load_row(data, total, rate, username, user_id, date)
+    rpm_total = row[8]
+    try:
+        await run_blocking("outbox", outbox.put, new_load_id(), row)
+    except Exception:
+        logger.exception("Could not store submission in the outbox")
+        await update.effective_message.reply_text("❌ Submission failed. Please try again.")
+        return
+    if not context.job_queue.get_jobs_by_name("outbox_flush_now"):
+        context.job_queue.run_once(flush_outbox, OUTBOX_FLUSH_DELAY, name="outbox_flush_now")
+
+    # загрузка уже в outbox; город для поста — необязательное украшение
+    try:
+        pickup_city, pickup_state = await resolve_location_async(data["pickup_zip"])
+        delivery_city, delivery_state = await resolve_location_async(data["delivery_zip"])
+    except Exception:
+        logger.exception("Geocoding failed, publishing raw ZIPs")
+        pickup_city, pickup_state = "", data["pickup_zip"]
+        delivery_city, delivery_state = "", data["delivery_zip"]
+    pickup = f"{pickup_city}, {pickup_state}" if pickup_city else pickup_state
+    delivery = f"{delivery_city}, {delivery_state}" if delivery_city else delivery_state
 
     text = (
         f"🗓 {date}\n"
@@ -256,52 +1893,83 @@ async def finalize_submission(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"💬 Comment: {data['comment'] or '—'}"
     )
 
-    m1 = await context.bot.send_message(chat_id="@rateguard", text=text)
-    m2 = await context.bot.send_message(chat_id="-1002235875053", text=text)
+    publisher.publish(context.bot, text)
     m3 = await update.effective_message.reply_text("✅ Load submitted and published!")
-    await asyncio.sleep(5)
-    await context.bot.delete_message(update.effective_chat.id, m3.message_id)
+    schedule_delete(context, update.effective_chat.id, [m3.message_id], 5)
 
+@instrumented()
 async def start_edit_load(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     data = query.data.split("_")
-    if len(data) < 3:
+    if len(data) not in (2, 4):
         await query.message.reply_text("❌ Invalid load ID.")
         return
-
-    _, date_str, pickup_zip, user_id = data
     user_id = str(update.effective_user.id)
 
-    # Загрузка таблицы
-    sheet = get_sheet()
-    records = sheet.get_all_records()
     # Очистка старых сообщений из /my_loads
     if "my_load_messages" in context.user_data:
-        for msg_id in context.user_data["my_load_messages"]:
-            try:
-                await context.bot.delete_message(update.effective_chat.id, msg_id)
-            except:
-                pass
+        schedule_delete(context, update.effective_chat.id, context.user_data["my_load_messages"])
         context.user_data["my_load_messages"] = []  # очистка списка
-    for i, row in enumerate(records):
-        if row["Pickup ZIP"] == pickup_zip and str(row["User ID"]) == user_id:
-            edit_state[user_id] = {
-                "row_index": i + 2,  # +2, т.к. строки начинаются с 1, и есть заголовок
-                "data": row,
-                "step": 0
-            }
-            break
+
+    if not await loads_ready(update):
+        return
+    row_number = None
+    if len(data) == 2:
+        load_id = data[1]
+        row_number = await run_blocking("sheets", locate_load, load_id)
     else:
+        # кнопки, отправленные до появления Load ID: edit_{date}_{pickup zip}_{user id}
+        position = find_legacy_load(user_id, data[1], data[2])
+        if position is not None:
+            with load_store.lock:
+                load_id = load_store.record(position).get(LOAD_ID_COLUMN, "")
+            if load_id:
+                row_number = await run_blocking("sheets", locate_load, load_id)
+            else:
+                row_number = position + 2  # +2, т.к. строки начинаются с 1, и есть заголовок
+
+    if row_number is not None:
+        with load_store.lock:
+            owner = str(load_store.record(row_number - 2).get("User ID", ""))
+    if row_number is None or owner != user_id:
         await query.message.reply_text("❌ Load not found.")
         return
 
+    edit_state.set(user_id, EditState(load_id, row_number, query.message.chat_id, query.message.message_id))
     await show_edit_menu(update, context)
 
+
+def find_legacy_load(user_id, date_str, pickup_zip):
+    """Position of a load by date, pickup ZIP and user, or None."""
+    try:
+        day = date.fromisoformat(date_str)
+    except ValueError:
+        return None
+    with load_store.lock:
+        column = load_store.header.index("Pickup ZIP")
+        for i in load_table.between(user_id, day, day):
+            if str(load_store.rows[i][column]) == pickup_zip:
+                return i
+    return None
+
 async def show_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    row = edit_state[user_id]["data"]
+    state = edit_state.get(user_id)
+    if state is None:
+        return
+    with load_store.lock:
+        # лист могли перечитать с тех пор — позицию загрузки с ID берём из индекса
+        position = load_index.positions.get(state.load_id) if state.load_id else state.row_index - 2
+        row = None
+        if position is not None and 0 <= position < len(load_store.rows):
+            row = load_store.record(position)
+            state.row_index = position + 2
+    if row is None or str(row.get("User ID", "")) != user_id:
+        edit_state.pop(user_id)
+        await context.bot.send_message(state.chat_id, "❌ Load not found.")
+        return
     pickup = row["Pickup ZIP"]
     delivery = row["Delivery ZIP"]
     trailer = row["Trailer"]
@@ -325,62 +1993,259 @@ async def show_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔁 Cancel", callback_data="cancel_edit")]
     ]
 
-    await update.callback_query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode="Markdown")
+    # меню — сообщение с карточкой из /my_loads; после ввода значения апдейт уже
+    # текстовый, поэтому правим его по id, а не через callback_query
+    await context.bot.edit_message_text(text=text, chat_id=state.chat_id, message_id=state.menu_message_id,
+                                        reply_markup=InlineKeyboardMarkup(buttons), parse_mode="Markdown")
+
+# === ZIP lookup table ===
+# pgeocode's US postal data compiled once into a flat file that is mmap-ed at
+# runtime: one slot per 5-digit ZIP in each column (lat, lon, place, state), so
+# a lookup is an index into arrays instead of a pandas query.
+#
+# Build it at deploy time, next to the code — pgeocode downloads its GeoNames
+# data for that:
+#
+#   python main.py zip-table
+#
+# Without the file the bot still builds it on first use, but then the first
+# lookups wait for that download.
+#
+# Layout (native byte order): header "<8sIII" (magic, slots, strings, blob size),
+# then float32 lat[slots], float32 lon[slots], uint32 place[slots],
+# uint32 state[slots], uint32 offsets[strings + 1] and the utf-8 string blob.
+# String 0 is "", so state == 0 marks an unknown ZIP.
+
+ZIP_TABLE_PATH = os.getenv("ZIP_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "zip_table.bin"))
+ZIP_TABLE_MAGIC = b"RGZIP\x00\x00\x02"  # 02 — данные из query_postal_code, один ZIP — одна запись
+ZIP_SLOTS = 100000
+_ZIP_HEADER = struct.Struct("<8sIII")
+
+
+def build_zip_table(path=ZIP_TABLE_PATH):
+    import pgeocode  # нужен только для сборки таблицы
+
+    # публичный query_postal_code: места с общим ZIP уже слиты (координаты усреднены,
+    # названия через запятую) — ровно то, что отдавал поиск по одному ZIP
+    data = pgeocode.Nominatim("us").query_postal_code([f"{slot:05d}" for slot in range(ZIP_SLOTS)])
+    lat = array("f", [float("nan")]) * ZIP_SLOTS
+    lon = array("f", [float("nan")]) * ZIP_SLOTS
+    place = array("I", [0]) * ZIP_SLOTS
+    state = array("I", [0]) * ZIP_SLOTS
+    strings = {"": 0}
+
+    def string_id(value):
+        value = value if isinstance(value, str) else ""
+        return strings.setdefault(value, len(strings))
+
+    for code, place_name, state_code, latitude, longitude in zip(
+            data["postal_code"], data["place_name"], data["state_code"], data["latitude"], data["longitude"]):
+        code = str(code)
+        if len(code) != 5 or not code.isdigit() or not isinstance(state_code, str):
+            continue
+        slot = int(code)
+        lat[slot] = latitude
+        lon[slot] = longitude
+        place[slot] = string_id(place_name)
+        state[slot] = string_id(state_code)
+
+    blob = bytearray()
+    offsets = array("I", [0])
+    for value in strings:  # dict хранит порядок вставки = порядок id
+        blob += value.encode("utf-8")
+        offsets.append(len(blob))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_ZIP_HEADER.pack(ZIP_TABLE_MAGIC, ZIP_SLOTS, len(strings), len(blob)))
+        for column in (lat, lon, place, state, offsets):
+            f.write(column.tobytes())
+        f.write(blob)
+    os.replace(tmp_path, path)
+    logger.info("ZIP table built: %d strings, %d bytes", len(strings), os.path.getsize(path))
+
+
+class ZipTable:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, slots, n_strings, blob_size = _ZIP_HEADER.unpack_from(self._mm)
+        if magic != ZIP_TABLE_MAGIC or slots != ZIP_SLOTS:
+            raise ValueError(f"{path} is not a ZIP table")
+        view = memoryview(self._mm)
+        pos = _ZIP_HEADER.size
+
+        def section(fmt, count):
+            nonlocal pos
+            size = count * 4
+            column = view[pos:pos + size].cast(fmt)
+            pos += size
+            return column
+
+        self.lat = section("f", slots)
+        self.lon = section("f", slots)
+        self.place = section("I", slots)
+        self.state = section("I", slots)
+        self._offsets = section("I", n_strings + 1)
+        self._blob = view[pos:pos + blob_size]
+
+    def _string(self, n):
+        return str(self._blob[self._offsets[n]:self._offsets[n + 1]], "utf-8")
+
+    def lookup(self, slot):
+        state = self.state[slot]
+        if not state:
+            return None
+        return self._string(self.place[slot]), self._string(state), self.lat[slot], self.lon[slot]
+
+
+_zip_table = None
+_zip_table_lock = threading.Lock()
+
+
+def get_zip_table():
+    global _zip_table
+    if _zip_table is None:
+        with _zip_table_lock:
+            if _zip_table is None:
+                try:
+                    _zip_table = ZipTable(ZIP_TABLE_PATH)
+                except (OSError, ValueError):
+                    logger.warning("No usable ZIP table at %s, building it now (run `python main.py zip-table` "
+                                   "at deploy time instead)", ZIP_TABLE_PATH)
+                    build_zip_table()
+                    _zip_table = ZipTable(ZIP_TABLE_PATH)
+    return _zip_table
+
+
+def zip_text(value):
+    """ZIP as text; numericised ZIPs that lost their leading zeros (2134, 601) get them back."""
+    text = str(value).strip()
+    return text.zfill(5) if text.isdigit() and 3 <= len(text) < 5 else text
+
+
+@functools.lru_cache(maxsize=4096)
+def zip_lookup(value):
+    """(city, state, lat, lon) for a ZIP (ZIP+4 is cut to 5 digits), or None."""
+    code = str(value).strip()[:5]
+    if len(code) != 5 or not code.isdigit():
+        return None
+    backend_calls.inc("geocode", "lookup")
+    return get_zip_table().lookup(int(code))
 
-async def save_to_firebase(context):
-    data = context.user_data
-    date = datetime.now().strftime("%Y-%m-%d")
 
-    def resolve_location(value):
-        if len(value) == 2 and value.isalpha():
-            return ("", value)
-        info = nomi.query_postal_code(value)
-        return (info.place_name or "", info.state_code or value)
+def resolve_location(value):
+    if len(value) == 2 and value.isalpha():
+        return ("", value)
+    info = zip_lookup(value)
+    if info is None:
+        return ("", value)
+    return (info[0], info[1])
+
+
+async def resolve_location_async(value):
+    # первый вызов может собирать таблицу — это не для event loop
+    if _zip_table is None:
+        return await run_blocking("geocode", resolve_location, value)
+    return resolve_location(value)
 
-    pickup_city, pickup_state = resolve_location(data["pickup_zip"])
-    delivery_city, delivery_state = resolve_location(data["delivery_zip"])
-    pickup = f"{pickup_city}, {pickup_state}" if pickup_city else pickup_state
-    delivery = f"{delivery_city}, {delivery_state}" if delivery_city else delivery_state
 
-    total = float(data["total_miles"])
-    rate = float(data["rate"].replace("$", "").replace(",", "").strip())
-    rpm_total = round(rate / total, 2) if total else None
-
-    # Сохраняем в Firestore
-    doc = {
-        "Date": date,
-        "Pickup ZIP": data["pickup_zip"],
-        "Delivery ZIP": data["delivery_zip"],
-        "Total Miles": total,
-        "Rate": rate,
-        "RPM Total": rpm_total,
-        "Trailer": data["trailer"],
-        "User": data["username"],
-        "Comment": data["comment"],
-        "Posted By": data["username"],
-        "User ID": data["user_id"]
-    }
-    db.collection("loads").add(doc)
+# === Lane miles ===
+# Road miles estimated from ZIP centroids: great-circle distance times
+# ROAD_FACTOR, computed with NumPy straight over the mmap-ed lat/lon columns,
+# so one call handles a single lane at /submit step 3 or the whole load
+# history for /miles_check. States and unknown ZIPs give NaN.
 
-    # Отправляем сообщение в канал
-    message = (
-        f"🗓 {date}\n"
-        f"🧑‍✈️ Posted by: {data['username']}\n"
-        f"📍 {pickup} → {delivery}\n"
-        f"📏 Miles: {int(total)}\n"
-        f"💵 Rate: ${int(rate)} | RPM: Total — {rpm_total:.2f}\n"
-        f"🚛 Trailer: {data['trailer']}\n"
-        f"💬 Comment: {data['comment'] or '—'}"
-    )
-    await context.bot.send_message(chat_id="@rateguard", text=message)
+EARTH_RADIUS_MILES = 3958.8
+ROAD_FACTOR = float(os.getenv("ROAD_FACTOR", "1.2"))  # дороги длиннее прямой примерно на 20%
+MILES_TOLERANCE = float(os.getenv("MILES_TOLERANCE", "0.35"))  # допустимое отклонение от оценки, доля
+MILES_SLACK = float(os.getenv("MILES_SLACK", "50"))  # ...но не меньше стольких миль на коротких лейнах
 
-def resolve_location(value):
-    if len(value) == 2 and value.isalpha():
-        return ("", value)
-    info = nomi.query_postal_code(value)
-    return (info.place_name or "", info.state_code or value)
 
+def zip_slot(value):
+    """Table slot of a ZIP (ZIP+4 cut to 5 digits, numericised ZIPs without leading zeros too), or -1."""
+    code = str(value).strip().split("-")[0]
+    if not code.isdigit() or len(code) not in (3, 4, 5, 9):
+        return -1
+    return int(code[:5])
+
+
+def zip_slots(values):
+    """int64 array of zip_slot over a sequence; a pandas categorical is parsed once per category."""
+    import numpy as np
+
+    categorical = getattr(values, "cat", None)
+    if categorical is not None:
+        slots = np.append(zip_slots(categorical.categories), -1)  # код -1 (NaN) → слот -1
+        return slots[categorical.codes.to_numpy()]
+    return np.fromiter((zip_slot(value) for value in values), dtype=np.int64)
+
+
+def estimate_lane_miles(pickup, delivery):
+    """float64 array of estimated road miles for equal-length sequences of pickup/delivery ZIPs."""
+    import numpy as np
+
+    table = get_zip_table()
+    lat = np.frombuffer(table.lat, dtype=np.float32)
+    lon = np.frombuffer(table.lon, dtype=np.float32)
+    a, b = zip_slots(pickup), zip_slots(delivery)
+    known = (a >= 0) & (b >= 0)
+    a, b = np.where(known, a, 0), np.where(known, b, 0)
+
+    lat1, lat2 = np.radians(lat[a].astype(np.float64)), np.radians(lat[b].astype(np.float64))
+    dlon = np.radians(lon[b].astype(np.float64) - lon[a].astype(np.float64))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    miles = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(h, 1.0))) * ROAD_FACTOR
+    return np.where(known, miles, np.nan)
+
+
+def miles_outside_estimate(miles, estimate):
+    """Boolean mask (or bool) of miles that are off the estimate by more than the tolerance."""
+    import numpy as np
+
+    allowed = np.maximum(MILES_SLACK, MILES_TOLERANCE * estimate)
+    return np.abs(miles - estimate) > allowed  # NaN в оценке или милях — не выброс
 
+
+def suggest_lane_miles(pickup, delivery):
+    """Rounded estimate for one lane, or None when either end is not a known ZIP."""
+    estimate = float(estimate_lane_miles([pickup], [delivery])[0])
+    return None if estimate != estimate else int(round(estimate))
+
+
+async def suggest_lane_miles_async(pickup, delivery):
+    if _zip_table is None:
+        return await run_blocking("geocode", suggest_lane_miles, pickup, delivery)
+    return suggest_lane_miles(pickup, delivery)
+
+
+def mileage_outliers(limit=20):
+    """(checked lanes, outliers, worst rows) over the load history in one vectorized pass."""
+    import numpy as np
+
+    df = load_data(["Date", "Pickup ZIP", "Delivery ZIP", "Total Miles", LOAD_ID_COLUMN])
+    if df.empty or "Total Miles" not in df:
+        return 0, 0, []
+    estimate = estimate_lane_miles(df["Pickup ZIP"], df["Delivery ZIP"])
+    miles = df["Total Miles"].to_numpy(dtype=np.float64)
+    flagged = miles_outside_estimate(miles, estimate)
+    checked = int(np.count_nonzero(~np.isnan(estimate) & ~np.isnan(miles)))
+    positions = np.flatnonzero(flagged)
+    worst = positions[np.argsort(-np.abs(miles[positions] - estimate[positions]))][:limit]
+    rows = []
+    for i in worst:
+        record = df.iloc[i]
+        rows.append({
+            "load_id": str(record.get(LOAD_ID_COLUMN, "")) or "—",
+            "date": record["Date"].strftime("%Y-%m-%d") if record["Date"] == record["Date"] else "",
+            "lane": f"{record['Pickup ZIP']} → {record['Delivery ZIP']}",
+            "miles": miles[i],
+            "estimate": estimate[i],
+        })
+    return checked, len(positions), rows
+
+
+@instrumented()
 async def stats_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("Today", callback_data="today"),
@@ -390,6 +2255,7 @@ async def stats_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📊 Choose stats period:", reply_markup=InlineKeyboardMarkup(keyboard))
     return STATS_SELECT
 
+@instrumented()
 async def handle_stats_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -411,15 +2277,14 @@ async def handle_stats_selection(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("❌ Invalid selection.")
         return ConversationHandler.END
 
-    # Вот это — ключевое исправление:
-    df = load_data()
-    df = df[df['Date'] >= start.date()]
-
-    msg = generate_stats_message(label, df)
+    if not await loads_ready(update):
+        return ConversationHandler.END
+    msg = await cached_stats_message(label, start.date())
     await query.edit_message_text(msg)
     return ConversationHandler.END
 # === /my_stats ===
 
+@instrumented()
 async def my_stats_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[
         InlineKeyboardButton(day, callback_data=day.lower())
@@ -431,6 +2296,7 @@ async def my_stats_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📆 Choose start of your week:", reply_markup=InlineKeyboardMarkup(keyboard))
     return MY_STATS_DAY
 
+@instrumented()
 async def handle_my_day_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -460,35 +2326,42 @@ async def handle_my_day_selection(update: Update, context: ContextTypes.DEFAULT_
     start = start.date()
     end = end.date()
 
-    df = load_data()
     user_id = str(update.effective_user.id)
-
-    if "User ID" in df.columns:
-        df = df[df["User ID"].astype(str) == user_id]
-        df = df[(df['Date'] >= start) & (df['Date'] <= end)]
+    if FIRESTORE_MODE == "primary":
+        docs = await run_async("firestore", firestore_loads_between(user_id, start, end))
+        summary = summarize_loads(docs)
     else:
-        await query.edit_message_text("⚠️ Your user ID was not found in any entries. Please re-submit your load to enable stats tracking.")
-        return ConversationHandler.END
+        if not await loads_ready(update):
+            return ConversationHandler.END
+        if "User ID" not in load_store.header:
+            await query.edit_message_text("⚠️ Your user ID was not found in any entries. Please re-submit your load to enable stats tracking.")
+            return ConversationHandler.END
+        summary = load_table.summary(load_table.between(user_id, start, end))
 
     date_range = f"{start.strftime('%b %d')} to {end.strftime('%b %d')}"
     label = f"My Stats (from {text.title()}) — {date_range}"
 
-    if df.empty:
+    if not summary[0]:
         await query.edit_message_text(f"📊 {label}\nNo loads found for this period.")
     else:
-        msg = generate_my_stats_message(label, df)
+        msg = generate_my_stats_message(label, summary)
         await query.edit_message_text(msg)
 
     return ConversationHandler.END
 
+@instrumented()
 async def handle_edit_field_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     user_id = str(update.effective_user.id)
     field = query.data.split("_")[1]
+    state = edit_state.get(user_id)
+    if state is None:
+        await query.message.reply_text("⌛ Edit session expired. Open /my_loads again.")
+        return
 
-    edit_state[user_id]["field"] = field
+    state.field = field
 
     question_map = {
         "pickup": "Enter new Pickup ZIP:",
@@ -505,26 +2378,29 @@ async def handle_edit_field_selection(update: Update, context: ContextTypes.DEFA
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_edit")]])
     )
 
-    edit_state[user_id]["question_msg_id"] = msg.message_id
+    state.question_msg_id = msg.message_id
     return
 
 
+@instrumented()
 async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    if user_id not in edit_state:
+    state = edit_state.get(user_id)
+    if state is None or state.field is None:
         return
 
     value = update.message.text.strip()
-    field = edit_state[user_id]["field"]
-    row_idx = edit_state[user_id]["row_index"]
-    sheet = get_sheet()
+    field = state.field
+    # строки могли сдвинуть руками после последней синхронизации — сверяемся с листом перед записью
+    row_idx = await run_blocking("sheets", confirm_load_row, state.load_id, state.row_index, user_id)
+    if row_idx is None:
+        edit_state.pop(user_id)
+        await update.message.reply_text("❌ Load not found or changed in the sheet. Open it again from /my_loads.")
+        return
+    state.row_index = row_idx
 
     # Очистим вопрос и ответ
-    try:
-        await context.bot.delete_message(update.effective_chat.id, edit_state[user_id]["question_msg_id"])
-        await context.bot.delete_message(update.effective_chat.id, update.message.message_id)
-    except:
-        pass
+    schedule_delete(context, update.effective_chat.id, [state.question_msg_id, update.message.message_id])
 
     # Обновим всезначение
     field_map = {
@@ -537,90 +2413,406 @@ async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     col_name = field_map[field]
 
-    sheet.update_cell(row_idx, get_column_index(sheet, col_name), value)
-    edit_state[user_id]["data"][col_name] = value
-
-    # ✅ Добавить вот это:
+    changes = {col_name: value}
     if field in ["miles", "rate"]:
-        update_rpm_in_edit(sheet, row_idx, edit_state[user_id]["data"])
-
+        with load_store.lock:
+            updated_data = load_store.record(row_idx - 2)
+        updated_data[col_name] = value
+        rpm = recalc_rpm(updated_data)
+        if rpm != "":
+            changes["RPM Total"] = str(rpm)
+
+    await run_blocking("sheets", sheet_call, write_cells, row_idx, changes)
+    for name, new_value in changes.items():
+        load_store.apply_update(row_idx, name, new_value)
+    if FIRESTORE_MODE != "off" and state.load_id:
+        context.application.create_task(firestore_update(state.load_id, changes))
+
+    state.field = None  # следующее сообщение — уже не новое значение
     msg = await context.bot.send_message(update.effective_chat.id, "✅ Value updated.")
-    await asyncio.sleep(3)
-    await context.bot.delete_message(update.effective_chat.id, msg.message_id)
+    schedule_delete(context, update.effective_chat.id, [msg.message_id], 3)
 
     await show_edit_menu(update, context)
 
 
+# === FMCSA client ===
+# Async client with keep-alive pooling, an LRU+TTL cache (misses are cached too,
+# for a shorter time) and single-flight: concurrent /broker calls for the same
+# number share one request. FMCSA_BASE_URL can point at a local stub server.
+
+FMCSA_BASE_URL = os.getenv("FMCSA_BASE_URL", "https://mobile.fmcsa.dot.gov/qc/services")
+FMCSA_CACHE_SIZE = int(os.getenv("FMCSA_CACHE_SIZE", "2048"))
+FMCSA_CACHE_TTL = int(os.getenv("FMCSA_CACHE_TTL", str(6 * 3600)))
+FMCSA_NEGATIVE_TTL = int(os.getenv("FMCSA_NEGATIVE_TTL", "900"))
+FMCSA_RETRIES = int(os.getenv("FMCSA_RETRIES", "3"))
+
+
+class FmcsaClient:
+    def __init__(self, base_url, api_key):
+        self.base_url = base_url
+        self.api_key = api_key
+        self._http = None
+        self._cache = OrderedDict()  # number -> (expires_at, carrier dict или None)
+        self._inflight = {}          # number -> asyncio.Future
+
+    def _client(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=BACKEND_TIMEOUTS["fmcsa"],
+                limits=httpx.Limits(max_connections=BACKEND_LIMITS["fmcsa"],
+                                    max_keepalive_connections=BACKEND_LIMITS["fmcsa"]),
+            )
+        return self._http
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def _cached(self, number):
+        entry = self._cache.get(number)
+        if entry is None:
+            return False, None
+        if entry[0] < time.monotonic():
+            del self._cache[number]
+            return False, None
+        self._cache.move_to_end(number)
+        return True, entry[1]
+
+    def _remember(self, number, carrier):
+        ttl = FMCSA_CACHE_TTL if carrier is not None else FMCSA_NEGATIVE_TTL
+        self._cache[number] = (time.monotonic() + ttl, carrier)
+        self._cache.move_to_end(number)
+        while len(self._cache) > FMCSA_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def lookup(self, number, docket=False):
+        """Carrier dict for a DOT number (an MC number with docket=True), or None if FMCSA has no such entity."""
+        key = f"MC{number}" if docket else number
+        hit, carrier = self._cached(key)
+        if hit:
+            return carrier
+
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            carrier = await self._fetch(f"/carriers/docket-number/{number}" if docket else f"/carriers/{number}",
+                                        "docket-number" if docket else "carriers")
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ждущих может не быть — не засоряем лог "exception was never retrieved"
+            raise
+        else:
+            self._remember(key, carrier)
+            future.set_result(carrier)
+            return carrier
+        finally:
+            del self._inflight[key]
+
+    async def _fetch(self, path, operation):
+        for attempt in range(FMCSA_RETRIES):
+            last_attempt = attempt == FMCSA_RETRIES - 1
+            if attempt:
+                backend_retries.inc("fmcsa")
+            backend_calls.inc("fmcsa", operation)
+            try:
+                response = await self._client().get(path, params={"webKey": self.api_key})
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code == 200:
+                    data = response.json()
+                    if not data or "content" not in data or not data["content"]:
+                        return None
+                    entry = data["content"][0]
+                    return entry.get("carrier", entry)  # docket-number отдаёт [{"carrier": {...}}]
+                retryable = response.status_code == 429 or response.status_code >= 500
+                if not retryable or last_attempt:
+                    raise Exception(f"API returned status code {response.status_code}")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+fmcsa_client = FmcsaClient(FMCSA_BASE_URL, FMCSA_API_KEY)
+
+
+# === Offline FMCSA index ===
+# A local copy of an FMCSA census/authority snapshot (CSV, .csv.gz or .zip) in
+# SQLite: carriers by DOT number (primary key) and MC/docket number, plus a
+# names table for legal/DBA name prefix search. /broker answers from it without
+# the network and falls back to the live API only for numbers it does not know.
+# With FMCSA_SNAPSHOT_URL set (URL or local path) a job rebuilds the index every
+# FMCSA_SNAPSHOT_REFRESH seconds into a temp file and swaps it in with os.replace.
+#
+#   python main.py fmcsa-index census.csv   — собрать индекс вручную
+
+FMCSA_INDEX_PATH = os.getenv("FMCSA_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fmcsa_index.sqlite3"))
+FMCSA_SNAPSHOT_URL = os.getenv("FMCSA_SNAPSHOT_URL", "")
+FMCSA_SNAPSHOT_REFRESH = int(os.getenv("FMCSA_SNAPSHOT_REFRESH", str(24 * 3600)))
+FMCSA_SNAPSHOT_COLUMNS = {
+    "dot": ("DOT_NUMBER", "USDOT_NUMBER", "DOT"),
+    "mc": ("DOCKET_NUMBER", "MC_NUMBER", "MC_MX_FF_NUMBER", "DOCKET"),
+    "legal_name": ("LEGAL_NAME", "NAME"),
+    "dba_name": ("DBA_NAME",),
+    "phone": ("TELEPHONE", "PHONE", "PHONE_NUMBER"),
+    "status": ("STATUS", "STATUS_CODE", "ENTITY_STATUS", "CARRIER_STATUS"),
+}
+fmcsa_index_lookups = MetricCounter("rateguard_fmcsa_index_total", "/broker lookups in the local FMCSA index",
+                                    ("result",))
+
+
+def fmcsa_name_key(name):
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in str(name).upper()).split())
+
+
+def _snapshot_number(value):
+    digits = "".join(filter(str.isdigit, str(value)))
+    return int(digits) if digits else None
+
+
+def read_fmcsa_snapshot(path):
+    """Yields {dot, mc, legal_name, dba_name, phone, status} from a snapshot file."""
+    with contextlib.ExitStack() as stack:
+        if path.lower().endswith(".zip"):
+            archive = stack.enter_context(zipfile.ZipFile(path))
+            raw = stack.enter_context(archive.open(archive.namelist()[0]))
+            f = stack.enter_context(io.TextIOWrapper(raw, encoding="utf-8-sig", errors="replace", newline=""))
+        else:
+            opener = gzip.open if path.lower().endswith(".gz") else open
+            f = stack.enter_context(opener(path, "rt", encoding="utf-8-sig", errors="replace", newline=""))
+        reader = csv.reader(f)
+        header = [name.strip().upper() for name in next(reader, [])]
+        columns = {}
+        for field, aliases in FMCSA_SNAPSHOT_COLUMNS.items():
+            columns[field] = next((header.index(alias) for alias in aliases if alias in header), None)
+        if columns["dot"] is None:
+            raise ValueError(f"{path}: no DOT number column")
+        for values in reader:
+            yield {field: values[n].strip() if n is not None and n < len(values) else ""
+                   for field, n in columns.items()}
+
+
+def build_fmcsa_index(source, path=FMCSA_INDEX_PATH):
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    count = 0
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE carriers (dot INTEGER PRIMARY KEY, mc INTEGER, legal_name TEXT, dba_name TEXT,"
+                     " phone TEXT, status TEXT)")
+        conn.execute("CREATE TABLE names (key TEXT, dot INTEGER, PRIMARY KEY (key, dot)) WITHOUT ROWID")
+        carriers, names = [], []
+        for record in read_fmcsa_snapshot(source):
+            dot = _snapshot_number(record["dot"])
+            if dot is None:
+                continue
+            carriers.append((dot, _snapshot_number(record["mc"]), record["legal_name"], record["dba_name"],
+                             record["phone"], record["status"]))
+            for name in (record["legal_name"], record["dba_name"]):
+                if name:
+                    names.append((fmcsa_name_key(name), dot))
+            if len(carriers) >= 10000:
+                count += len(carriers)
+                conn.executemany("INSERT OR REPLACE INTO carriers VALUES (?, ?, ?, ?, ?, ?)", carriers)
+                conn.executemany("INSERT OR IGNORE INTO names VALUES (?, ?)", names)
+                carriers, names = [], []
+        count += len(carriers)
+        conn.executemany("INSERT OR REPLACE INTO carriers VALUES (?, ?, ?, ?, ?, ?)", carriers)
+        conn.executemany("INSERT OR IGNORE INTO names VALUES (?, ?)", names)
+        conn.execute("CREATE INDEX carriers_mc ON carriers (mc)")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    logger.info("FMCSA index built: %d carriers, %d bytes", count, os.path.getsize(path))
+    return count
+
+
+def update_fmcsa_index(source=FMCSA_SNAPSHOT_URL, path=FMCSA_INDEX_PATH):
+    """Downloads the snapshot if source is a URL, then rebuilds the index."""
+    if not source.startswith(("http://", "https://")):
+        return build_fmcsa_index(source, path)
+    suffix = next((s for s in (".zip", ".gz") if source.lower().split("?")[0].endswith(s)), ".csv")
+    fd, download = tempfile.mkstemp(prefix="rateguard-fmcsa-", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f, httpx.stream("GET", source, follow_redirects=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(1 << 20):
+                f.write(chunk)
+        return build_fmcsa_index(download, path)
+    finally:
+        os.remove(download)
+
+
+class FmcsaIndex:
+    """Read-only view of the index; used from the event loop only (lookups are index seeks)."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+    @staticmethod
+    def _carrier(row):
+        dot, mc, legal_name, dba_name, phone, status = row
+        return {"legalName": legal_name or dba_name, "dbaName": dba_name, "dotNumber": dot,
+                "docketNumber": f"MC{mc}" if mc else "N/A", "phoneNumber": phone or "N/A",
+                "entityStatus": status or "N/A"}
+
+    def by_dot(self, dot):
+        row = self._conn.execute("SELECT * FROM carriers WHERE dot = ?", (dot,)).fetchone()
+        return self._carrier(row) if row else None
+
+    def by_mc(self, mc):
+        row = self._conn.execute("SELECT * FROM carriers WHERE mc = ? LIMIT 1", (mc,)).fetchone()
+        return self._carrier(row) if row else None
+
+    def by_name(self, text, limit=5):
+        prefix = fmcsa_name_key(text)
+        if not prefix:
+            return []
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self._conn.execute(
+            "SELECT carriers.* FROM names JOIN carriers USING (dot)"
+            " WHERE names.key >= ? AND names.key < ? ORDER BY names.key LIMIT ?",
+            (prefix, upper, limit),
+        ).fetchall()
+        return [self._carrier(row) for row in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+_fmcsa_index = None
+
+
+def get_fmcsa_index():
+    global _fmcsa_index
+    if _fmcsa_index is None and os.path.exists(FMCSA_INDEX_PATH):
+        _fmcsa_index = FmcsaIndex(FMCSA_INDEX_PATH)
+    return _fmcsa_index
+
+
+async def refresh_fmcsa_index(context: ContextTypes.DEFAULT_TYPE):
+    global _fmcsa_index
+    try:
+        await run_blocking("fmcsa_index", update_fmcsa_index)
+    except Exception:
+        logger.exception("FMCSA index refresh failed, keeping the current one")
+        return
+    # подмена на event loop, чтобы не закрыть соединение посреди поиска
+    old, _fmcsa_index = _fmcsa_index, FmcsaIndex(FMCSA_INDEX_PATH)
+    if old is not None:
+        old.close()
+
+
+def _fmcsa_index_first_refresh():
+    try:
+        age = time.time() - os.path.getmtime(FMCSA_INDEX_PATH)
+    except OSError:
+        return 0
+    return max(0, FMCSA_SNAPSHOT_REFRESH - age)
+
+
+def _broker_query(text):
+    """("mc" | "dot" | "name", value) for a /broker argument."""
+    upper = text.strip().upper()
+    for prefix, kind in (("USDOT", "dot"), ("DOT", "dot"), ("MC", "mc")):
+        rest = upper[len(prefix):].strip(" #:-") if upper.startswith(prefix) else None
+        if rest and rest.isdigit():
+            return kind, int(rest)
+    digits = "".join(ch for ch in upper if ch not in " -#")
+    if digits.isdigit():
+        return "number", int(digits)
+    return "name", text.strip()
+
+
+def format_broker(broker):
+    return (
+        f"📦 *Broker Info:*\n"
+        f"• Name: {broker.get('legalName', 'N/A')}\n"
+        f"• DOT: {broker.get('dotNumber', 'N/A')}\n"
+        f"• MC: {broker.get('docketNumber', 'N/A')}\n"
+        f"• Phone: {broker.get('phoneNumber', 'N/A')}\n"
+        f"• Status: {broker.get('entityStatus', 'N/A')}"
+    )
+
+
+@instrumented()
 async def broker_lookup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("❗ Please provide MC or DOT number. Example: /broker 123456")
         return
 
-    raw_number = context.args[0]
-    number = ''.join(filter(str.isdigit, raw_number))
-
-    if not number:
+    kind, value = _broker_query(" ".join(context.args))
+    index = get_fmcsa_index()
+    if kind == "name" and index is None:
         await update.message.reply_text("❌ Invalid number format.")
         return
 
-    url = f"https://mobile.fmcsa.dot.gov/qc/services/carriers/{number}?webKey={FMCSA_API_KEY}"
-
     try:
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise Exception(f"API returned status code {response.status_code}")
-
-        data = response.json()
-
-        if not data or "content" not in data or not data["content"]:
+        broker = None
+        if index is not None:
+            if kind == "name":
+                matches = index.by_name(value)
+                fmcsa_index_lookups.inc("hit" if matches else "miss")
+                if not matches:
+                    await update.message.reply_text("⚠️ Broker not found.")
+                elif len(matches) == 1:
+                    await update.message.reply_text(format_broker(matches[0]), parse_mode="Markdown")
+                else:
+                    lines = [f"• {m['legalName']} — DOT {m['dotNumber']}, {m['docketNumber']}" for m in matches]
+                    await update.message.reply_text("🔎 Matches:\n" + "\n".join(lines))
+                return
+            if kind in ("dot", "number"):
+                broker = index.by_dot(value)
+            if broker is None and kind in ("mc", "number"):
+                broker = index.by_mc(value)
+            fmcsa_index_lookups.inc("hit" if broker is not None else "miss")
+
+        # в живой API — только если индекса нет или в нём пусто; голое число — сначала DOT, потом MC
+        if broker is None and kind in ("dot", "number"):
+            broker = await fmcsa_client.lookup(str(value))
+        if broker is None and kind in ("mc", "number"):
+            broker = await fmcsa_client.lookup(str(value), docket=True)
+        if broker is None:
             await update.message.reply_text("⚠️ Broker not found.")
             return
 
-        broker = data["content"][0]
-        name = broker.get("legalName", "N/A")
-        dot = broker.get("dotNumber", "N/A")
-        mc = broker.get("docketNumber", "N/A")
-        phone = broker.get("phoneNumber", "N/A")
-        status = broker.get("entityStatus", "N/A")
-
-        message = (
-            f"📦 *Broker Info:*\n"
-            f"• Name: {name}\n"
-            f"• DOT: {dot}\n"
-            f"• MC: {mc}\n"
-            f"• Phone: {phone}\n"
-            f"• Status: {status}"
-        )
-
-        await update.message.reply_text(message, parse_mode="Markdown")
+        await update.message.reply_text(format_broker(broker), parse_mode="Markdown")
 
-    except Exception as e:
-        print(f"Error: {e}")
+    except Exception:
+        logger.exception("FMCSA lookup failed for %s", value)
         await update.message.reply_text("❌ Error fetching broker data.")
 
+@instrumented()
 async def my_loads(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    sheet = get_sheet()
-    data = sheet.get_all_records()
-    df = pd.DataFrame(data)
-
-    # Приводим типы и фильтруем по user_id
-    df = df[df["User ID"].astype(str) == user_id]
-    df["Date"] = pd.to_datetime(df["Date"], errors='coerce')
-    df = df.dropna(subset=["Date"])  # удалим строки без даты
-    df = df.sort_values(by="Date", ascending=False).head(5)
+    if FIRESTORE_MODE == "primary":
+        docs = await run_async("firestore", firestore_latest_loads(user_id, 5))
+        loads = [(doc, doc["Date"]) for doc in docs]
+    else:
+        if not await loads_ready(update):
+            return
+        with load_store.lock:  # позиции годны, пока sync-поток не подменил строки
+            loads = [(load_store.record(i), date.fromordinal(load_table.day[i])) for i in load_table.latest(user_id, 5)]
 
-    if df.empty:
+    if not loads:
         await update.message.reply_text("🚫 You don't have any submitted loads yet.")
         return
 
-    for _, row in df.iterrows():
-        # Генерация ID груза
-        load_id = f"{row['Date'].date()}_{row['Pickup ZIP']}_{user_id}"
+    for row, load_date in loads:
+        # строки без Load ID (backfill ещё не прошёл) — по дате, ZIP и пользователю
+        load_id = row.get(LOAD_ID_COLUMN) or f"{load_date}_{row['Pickup ZIP']}_{user_id}"
 
         # Текст груза
         text = (
-            f"🗓 {row['Date'].date()}\n"
+            f"🗓 {load_date}\n"
             f"📍 {row['Pickup ZIP']} → {row['Delivery ZIP']}\n"
             f"📏 Miles: {row['Total Miles']}\n"
             f"💵 Rate: ${row['Rate']} | RPM: {row.get('RPM Total', '—')}\n"
@@ -634,45 +2826,642 @@ async def my_loads(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text(text, reply_markup=keyboard)
 
+@instrumented()
 async def cancel_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     msg = await query.message.reply_text("❌ Editing canceled.")
-    await asyncio.sleep(5)
-    await context.bot.delete_message(chat_id=msg.chat.id, message_id=msg.message_id)
+    schedule_delete(context, msg.chat.id, [msg.message_id], 5)
     user_id = str(update.effective_user.id)
-    if user_id in edit_state:
-        del edit_state[user_id]
+    if edit_state.pop(user_id) is not None:
         return ConversationHandler.END
 
-def get_column_index(sheet, column_name):
-    header = sheet.row_values(1)
-    return header.index(column_name) + 1
-
-def update_rpm_in_edit(sheet, row_idx, updated_data):
+def recalc_rpm(updated_data):
     """
-    Обновляет RPM Total в Google Sheet после редактирования 'Rate' или 'Total Miles'.
+    Пересчитывает RPM Total после редактирования 'Rate' или 'Total Miles'; "" если посчитать нельзя.
     """
     try:
         rate = float(updated_data.get("Rate", 0))
         miles = float(updated_data.get("Total Miles", 0))
-        rpm = round(rate / miles, 2) if miles else ""
-    except Exception as e:
-        rpm = ""
-
-    if rpm != "":
-        # Найдём индекс колонки "RPM Total"
-        header = sheet.row_values(1)
-        if "RPM Total" in header:
-            col_index = header.index("RPM Total") + 1
-            sheet.update_cell(row_idx, col_index, str(rpm))
-            return True
-    return False
+        return round(rate / miles, 2) if miles else ""
+    except Exception:
+        return ""
+
+def write_cells(sheet, row_idx, changes):
+    """Writes {column name: value} into one sheet row with a single batch_update call."""
+    import gspread
+    columns = load_store.column_map()
+    if any(name not in columns for name in changes):
+        # заголовок поменяли руками — перечитываем таблицу и карту колонок
+        load_store.reload()
+        columns = load_store.column_map()
+    sheet.batch_update([
+        {"range": gspread.utils.rowcol_to_a1(row_idx, columns[name]), "values": [[value]]}
+        for name, value in changes.items()
+    ], value_input_option="USER_ENTERED")
+
+
+# === /export ===
+# Load history as gzip-ed CSV or Parquet. Rows are read from a snapshot of the
+# load store (reload swaps in a new list, appends only grow it) EXPORT_CHUNK_ROWS
+# at a time and written straight to a temp file in an I/O thread, so a large
+# export holds one chunk in memory and never runs on the event loop.
+#
+#   /export [from=YYYY-MM-DD] [to=YYYY-MM-DD] [trailer=Reefer] [user=<id>|@name|all] [format=csv|parquet]
+#
+# Without ADMIN_IDS membership only your own loads are exported.
+
+ADMIN_IDS = {admin.strip() for admin in os.getenv("ADMIN_IDS", "").split(",") if admin.strip()}
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+EXPORT_FLOAT_COLUMNS = {"Total Miles", "Rate", "RPM Loaded", "RPM Total"}
+EXPORT_USAGE = ("Usage: /export [from=YYYY-MM-DD] [to=YYYY-MM-DD] [trailer=Reefer] "
+                "[user=<id>|@name|all] [format=csv|parquet]")
+
+
+def parse_export_args(args):
+    options = {"from": None, "to": None, "trailer": None, "user": None, "format": "csv"}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        key = key.lower()
+        if not sep or key not in options or not value:
+            raise ValueError(arg)
+        if key in ("from", "to"):
+            value = date.fromisoformat(value)
+        elif key == "format" and value.lower() not in ("csv", "parquet"):
+            raise ValueError(arg)
+        options[key] = value.lower() if key == "format" else value
+    return options
+
+
+class CsvExport:
+    suffix = ".csv.gz"
+
+    def __init__(self, path, header):
+        self._file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+
+    def write(self, rows, days):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetExport:
+    """One row group per chunk; Date becomes date32, the money/miles columns float64."""
+    suffix = ".parquet"
+
+    def __init__(self, path, header):
+        import pyarrow as pa  # опциональная зависимость, только для format=parquet
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self.header = header
+        self.schema = pa.schema([
+            (name, pa.date32() if name == "Date" else pa.float64() if name in EXPORT_FLOAT_COLUMNS else pa.string())
+            for name in header
+        ])
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows, days):
+        columns = []
+        for n, name in enumerate(self.header):
+            if name == "Date":
+                values = [date.fromordinal(day) if day else None for day in days]
+            elif name in EXPORT_FLOAT_COLUMNS:
+                values = [to_float(row[n], decimal_comma=True) for row in rows]
+            else:
+                values = [None if row[n] == "" else str(row[n]) for row in rows]
+            columns.append(self._pa.array(values, type=self.schema.field(n).type))
+        self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def write_export(path, options, user_id):
+    """Writes the matching loads to path; user_id limits the export to one user. Returns the row count."""
+    start, end = options["from"], options["to"]
+    trailer = (options["trailer"] or "").lower()
+    with load_store.lock:
+        header = load_store.header
+        rows, days = load_store.rows, load_table.day
+        if user_id:
+            positions = load_table.between(user_id, start or date.min, end or date.max)
+        else:
+            positions = range(len(rows))
+    lo = start.toordinal() if start else None
+    hi = end.toordinal() if end else None
+    username = options["user"].lower() if options["user"] and options["user"].startswith("@") else None
+    trailer_col = header.index("Trailer") if "Trailer" in header else None
+    user_col = header.index("User") if "User" in header else None
+    zip_cols = [n for n, name in enumerate(header) if name in ("Pickup ZIP", "Delivery ZIP")]
+
+    exporter = (ParquetExport if options["format"] == "parquet" else CsvExport)(path, header)
+    count = 0
+    try:
+        for k in range(0, len(positions), EXPORT_CHUNK_ROWS):
+            with load_store.lock:
+                chunk = [(rows[i], days[i]) for i in positions[k:k + EXPORT_CHUNK_ROWS]]
+            chunk = [
+                (row, day) for row, day in chunk
+                if (lo is None or day and day >= lo) and (hi is None or day and day <= hi)
+                and (not trailer or trailer_col is not None and str(row[trailer_col]).lower() == trailer)
+                and (not username or user_col is not None and str(row[user_col]).lower() == username)
+            ]
+            if chunk:
+                rows_out = [row for row, _ in chunk]
+                if zip_cols:
+                    # load store хранит ZIP-ы numericise-нутыми: 02134 -> 2134
+                    rows_out = [list(row) for row in rows_out]
+                    for row in rows_out:
+                        for n in zip_cols:
+                            row[n] = zip_text(row[n])
+                exporter.write(rows_out, [day for _, day in chunk])
+                count += len(chunk)
+    finally:
+        exporter.close()
+    return count
+
+
+@instrumented()
+async def export_loads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        options = parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+
+    user_id = str(update.effective_user.id)
+    if user_id not in ADMIN_IDS:
+        if options["user"] not in (None, user_id):
+            await update.message.reply_text("⛔ Only admins can export other users' loads.")
+            return
+        target = user_id
+    elif options["user"] in (None, "all") or options["user"].startswith("@"):
+        target = None
+    else:
+        target = options["user"]
+    if options["format"] == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        await update.message.reply_text("❌ Parquet export is not available here, use format=csv.")
+        return
+    if not await loads_ready(update):
+        return
+
+    status = await update.message.reply_text("⏳ Preparing export...")
+    suffix = ParquetExport.suffix if options["format"] == "parquet" else CsvExport.suffix
+    fd, path = tempfile.mkstemp(prefix="rateguard-export-", suffix=suffix)
+    os.close(fd)
+    try:
+        count = await run_blocking("export", write_export, path, options, target)
+        if not count:
+            await status.edit_text("🚫 No loads match these filters.")
+            return
+        if os.path.getsize(path) > EXPORT_MAX_BYTES:
+            await status.edit_text("❌ The export is larger than 50 MB, narrow the date range.")
+            return
+        period = f"{options['from'] or 'start'}_{options['to'] or date.today()}"
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id, document=f,
+                filename=f"rateguard_loads_{period}{suffix}", caption=f"📦 {count} loads",
+                read_timeout=120, write_timeout=120)
+        schedule_delete(context, update.effective_chat.id, [status.message_id])
+    finally:
+        os.remove(path)
+
+
+# === Bulk import ===
+# Historical loads from a CSV (.csv / .csv.gz, e.g. an /export file) or XLSX.
+# Rows go through the same number checks and RPM computation as /submit
+# (build_load_row), are deduplicated against the sheet and the file by their
+# content, and enter the outbox under an ID derived from that content, so
+# running the same file again after a failure resumes where it stopped. The
+# outbox is then flushed with one append_rows per IMPORT_BATCH_ROWS rows, paced
+# to IMPORT_WRITES_PER_MINUTE to stay inside the Sheets write quota. The regular
+# flush_outbox job leaves import rows (IMPORT_ID_PREFIX) alone, so only the
+# import itself sends them and the pacing holds.
+#
+#   python main.py import loads.csv [--user-id 123 --username @dispatch]
+#   /import as the caption of a document (admins only)
+
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "500"))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "500"))
+IMPORT_WRITES_PER_MINUTE = float(os.getenv("IMPORT_WRITES_PER_MINUTE", "30"))
+IMPORT_COLUMNS = {
+    "date": "date", "pickup zip": "pickup_zip", "delivery zip": "delivery_zip", "total miles": "total_miles",
+    "rate": "rate", "trailer": "trailer", "comment": "comment", "user": "username", "posted by": "username",
+    "user id": "user_id",
+}
+IMPORT_SUFFIXES = (".csv", ".csv.gz", ".xlsx")
+
+
+class ImportStats:
+    __slots__ = ("read", "queued", "duplicates", "invalid", "sent", "unknown_zips", "started")
+
+    def __init__(self):
+        self.read = self.queued = self.duplicates = self.invalid = self.sent = 0
+        self.unknown_zips = set()
+        self.started = time.monotonic()
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (f"{self.read} rows read, {self.queued} queued, {self.sent} written, "
+                f"{self.duplicates} duplicates, {self.invalid} invalid, {len(self.unknown_zips)} unknown ZIPs "
+                f"({self.read / elapsed:.0f} rows/s)")
+
+
+def _import_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # XLSX отдаёт ZIP и мили числами
+    return str(value).strip()
+
+
+def _zip_key(value):
+    return zip_text(value).upper()  # numericise съедает ведущие нули
+
+
+def load_content_key(day, pickup_zip, delivery_zip, miles, rate, trailer, user_id):
+    return (day, _zip_key(pickup_zip), _zip_key(delivery_zip), round(to_float(miles) or 0.0, 2),
+            round(to_float(rate) or 0.0, 2), str(trailer).strip().lower(), str(user_id).strip())
+
+
+def import_load_id(key):
+    # "im" + hex: не совпадает с token_hex и не numericise-ится
+    return IMPORT_ID_PREFIX + hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def _existing_load_keys():
+    with load_store.lock:
+        header, rows = load_store.header, load_store.rows
+    names = ("Date", "Pickup ZIP", "Delivery ZIP", "Total Miles", "Rate", "Trailer", "User ID")
+    columns = [header.index(name) if name in header else None for name in names]
+    keys = set()
+    for row in rows:
+        values = ["" if n is None else row[n] for n in columns]
+        day = parse_load_date(values[0])
+        if day is not None:
+            keys.add(load_content_key(day.isoformat(), *values[1:]))
+    return keys
+
+
+def read_import_rows(path):
+    """Yields {column: value} from a CSV, gzip-ed CSV or XLSX file, streaming."""
+    if path.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook  # опциональная зависимость, только для XLSX
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [_import_text(value) for value in next(rows, ())]
+            for values in rows:
+                yield dict(zip(header, values))
+        finally:
+            workbook.close()
+    else:
+        opener = gzip.open if path.lower().endswith(".gz") else open
+        with opener(path, "rt", newline="", encoding="utf-8-sig") as f:
+            yield from csv.DictReader(f)
+
+
+def _queue_import_chunk(records, stats, existing, default_user_id, default_username):
+    entries = []
+    zips = set()
+    for record in records:
+        stats.read += 1
+        data = {IMPORT_COLUMNS[name.strip().lower()]: _import_text(value)
+                for name, value in record.items() if name and name.strip().lower() in IMPORT_COLUMNS}
+        day = parse_load_date(data.get("date", ""))
+        user_id = data.get("user_id") or default_user_id
+        username = data.get("username") or default_username or user_id
+        if day is None or not data.get("pickup_zip") or not data.get("delivery_zip") or not user_id:
+            stats.invalid += 1
+            continue
+        # в /export и в листе ZIP-ы бывают без ведущих нулей — пишем их в лист как 02134
+        data["pickup_zip"], data["delivery_zip"] = zip_text(data["pickup_zip"]), zip_text(data["delivery_zip"])
+        try:
+            total, rate = parse_submission_numbers(data)
+        except (KeyError, ValueError):
+            stats.invalid += 1
+            continue
+        row = build_load_row(data, total, rate, username, user_id, day.isoformat())
+        key = load_content_key(row[0], row[1], row[2], row[5], row[6], row[9], row[14])
+        if key in existing:
+            stats.duplicates += 1
+            continue
+        existing.add(key)
+        entries.append((import_load_id(key), row))
+        zips.update((row[1], row[2]))
+    # ZIP-ы чанка проверяем по одному разу, а не в каждой строке
+    for value in zips:
+        if not (len(value) == 2 and value.isalpha()) and zip_lookup(value) is None:
+            stats.unknown_zips.add(value)
+    outbox.put_many(entries)
+    stats.queued += len(entries)
+
+
+def import_file(path, default_user_id="", default_username="", progress=None):
+    """Imports a CSV/XLSX file of loads; calls progress(stats) after every chunk and write."""
+    stats = ImportStats()
+    load_store.ensure_loaded()
+    pause = 60 / IMPORT_WRITES_PER_MINUTE
+
+    def flush():
+        while True:
+            sent = flush_outbox_batch(IMPORT_BATCH_ROWS, imported=True)
+            if not sent:
+                return
+            stats.sent += sent
+            if progress:
+                progress(stats)
+            time.sleep(pause)
+
+    flush()  # хвост прошлого, прерванного импорта — до сверки, чтобы он тоже считался уже записанным
+    existing = _existing_load_keys()
+    chunk = []
+    for record in read_import_rows(path):
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK_ROWS:
+            _queue_import_chunk(chunk, stats, existing, default_user_id, default_username)
+            chunk = []
+            if progress:
+                progress(stats)
+            flush()
+    if chunk:
+        _queue_import_chunk(chunk, stats, existing, default_user_id, default_username)
+    flush()
+    if progress:
+        progress(stats)
+    return stats
+
+
+async def run_import_job(bot, chat_id, status_message_id, path, user_id, username):
+    latest = {}
+
+    def progress(stats):
+        latest["text"] = stats.summary()  # из потока импорта; в чат пишем раз в несколько секунд
+
+    job = asyncio.ensure_future(run_blocking("import", import_file, path, user_id, username, progress))
+    shown = None
+    try:
+        while not job.done():
+            await asyncio.wait([job], timeout=5)
+            text = latest.get("text")
+            if text and text != shown and not job.done():
+                await bot.edit_message_text(f"⏳ Importing: {text}", chat_id=chat_id, message_id=status_message_id)
+                shown = text
+        stats = job.result()
+        await bot.edit_message_text(f"✅ Import done: {stats.summary()}", chat_id=chat_id,
+                                    message_id=status_message_id)
+    except Exception:
+        logger.exception("Import of %s failed", path)
+        await bot.edit_message_text("❌ Import failed. Send the same file again to resume.",
+                                    chat_id=chat_id, message_id=status_message_id)
+    finally:
+        os.remove(path)
+
+
+@instrumented()
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if str(user.id) not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Only admins can import loads.")
+        return
+    document = update.message.document if update.message else None
+    name = (document.file_name or "").lower() if document else ""
+    if not name.endswith(IMPORT_SUFFIXES):
+        await update.message.reply_text("Send a .csv, .csv.gz or .xlsx file with /import as its caption.")
+        return
+    if name.endswith(".xlsx") and importlib.util.find_spec("openpyxl") is None:
+        await update.message.reply_text("❌ XLSX import is not available here, send the file as .csv.")
+        return
 
+    status = await update.message.reply_text("⏳ Downloading the file...")
+    fd, path = tempfile.mkstemp(prefix="rateguard-import-", suffix=next(s for s in IMPORT_SUFFIXES if name.endswith(s)))
+    os.close(fd)
+    file = await document.get_file()
+    await file.download_to_drive(path)
+    username = f"@{user.username}" if user.username else user.full_name
+    # импорт идёт долго — не держим очередь апдейтов этого пользователя
+    context.application.create_task(
+        run_import_job(context.bot, update.effective_chat.id, status.message_id, path, str(user.id), username))
+
+
+def import_cli(argv):
+    parser = argparse.ArgumentParser(prog="main.py import", description="Bulk import historical loads.")
+    parser.add_argument("path", help=".csv, .csv.gz or .xlsx file with the sheet's column names")
+    parser.add_argument("--user-id", default="", help="User ID for rows that have none")
+    parser.add_argument("--username", default="", help="User / Posted By for rows that have none")
+    args = parser.parse_args(argv)
+    if args.path.lower().endswith(".xlsx") and importlib.util.find_spec("openpyxl") is None:
+        parser.error("XLSX import needs openpyxl (pip install openpyxl); or save the file as .csv")
+    try:
+        stats = import_file(args.path, args.user_id, args.username,
+                            progress=lambda stats: logger.info("Import: %s", stats.summary()))
+    finally:
+        outbox.close()
+    logger.info("Import done: %s", stats.summary())
 
 
-if __name__ == '__main__':
-    app = ApplicationBuilder().token(TOKEN).build()
+# === /miles_check ===
+
+@instrumented()
+async def miles_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Only admins can check mileage.")
+        return
+    if not await loads_ready(update):
+        return
+    checked, flagged, rows = await run_blocking("export", mileage_outliers)  # полный проход по истории, как у /export
+    lines = [f"📏 Checked {checked} lanes against ZIP distances, {flagged} look off."]
+    for row in rows:
+        lines.append(f"• {row['date']} {row['lane']}: {int(row['miles'])} mi, est. ~{int(row['estimate'])} ({row['load_id']})")
+    await update.message.reply_text("\n".join(lines))
+
+
+# === Startup ===
+# Nothing slow happens at import time. Sheets, the load store and the ZIP table
+# are warmed in the background once the application is up, and every backend
+# still initializes itself on first use if a command arrives earlier.
+
+async def warm_up():
+    timings = {}
+    for name, start in [
+        ("sheet", start_first_load),
+        ("zip table", lambda: run_blocking("geocode", get_zip_table)),
+        ("load IDs", lambda: run_blocking("load", backfill_load_ids)),  # sync внутри может перечитать лист
+    ]:
+        started = time.perf_counter()
+        try:
+            await start()
+        except Exception:
+            logger.exception("Warm-up of %s failed, it will be retried on first use", name)
+            continue
+        timings[name] = time.perf_counter() - started
+    logger.info("Warm-up done %.2fs after process start (%s)",
+                time.perf_counter() - _process_started,
+                ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+
+async def on_startup(app):
+    if app.persistence is not None:
+        for name, store in conversation_stores.items():
+            store.adopt(app.bot_data.get(name))
+            app.bot_data[name] = store
+    logger.info("Startup: ready to receive updates %.2fs after process start",
+                time.perf_counter() - _process_started)
+
+
+async def start_warm_up(context: ContextTypes.DEFAULT_TYPE):
+    # задача создаётся, когда приложение уже запущено, — Application.stop() её дождётся
+    context.application.create_task(warm_up())
+
+
+class CountingRequest(HTTPXRequest):
+    """Bot API transport that counts every Telegram call by method name."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        backend_calls.inc("telegram", endpoint)
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            backend_errors.inc("telegram")
+            raise
+        finally:
+            backend_latency.observe(time.perf_counter() - started, "telegram")
+
+
+@gauge("rateguard_queue_depth", "Work waiting in background queues", ("queue",))
+def _queue_depths():
+    return {
+        ("outbox",): outbox.pending_count(),
+        ("publisher",): publisher.queue_depth(),
+        ("deletions",): sum(len(pending) for pending in list(_pending_deletions.values())),
+    }
+
+
+@gauge("rateguard_conversation_state", "Entries in the conversation state stores", ("store",))
+def _conversation_state_sizes():
+    return {(name,): len(store) for name, store in conversation_stores.items()}
+
+
+@gauge("rateguard_loads", "Rows held by the load store")
+def _loads_held():
+    return {(): len(load_store.rows)}
+
+
+async def on_stop(app):
+    # бот ещё жив — допубликовываем очередь
+    await publisher.drain()
+
+
+async def on_shutdown(app):
+    # отправляем всё, что успели принять до остановки
+    await flush_outbox(None)
+    outbox.close()
+    await fmcsa_client.aclose()
+
+
+# === Application ===
+# BOT_MODE=polling (по умолчанию) или webhook. В webhook-режиме Telegram сам
+# присылает апдейты на WEBHOOK_URL; PTB поднимает async-сервер (tornado) на
+# WEBHOOK_LISTEN:WEBHOOK_PORT и проверяет X-Telegram-Bot-Api-Secret-Token.
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")        # публичный https-адрес вместе с путём
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # пусто — новый случайный при каждом запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Апдейты разных пользователей обрабатываются параллельно (до CONCURRENT_UPDATES
+# одновременно), апдейты одного пользователя — строго по очереди: на этом держатся
+# ConversationHandler'ы и edit_state.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+UPDATE_BACKLOG_LIMIT = int(os.getenv("UPDATE_BACKLOG_LIMIT", "1024"))
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Concurrent update processing that keeps each user's updates in arrival order."""
+
+    def __init__(self, max_running):
+        # PTB takes its semaphore before do_process_update, so it also counts updates
+        # that are only waiting for their user's turn; it bounds the backlog, and the
+        # number of updates actually running is limited by self._running
+        super().__init__(max(UPDATE_BACKLOG_LIMIT, max_running))
+        self.max_running = max_running
+        self._running = asyncio.Semaphore(max_running)
+        self._keys = {}  # key -> [lock, updates holding or waiting for it]
+
+    @staticmethod
+    def update_key(update):
+        if not isinstance(update, Update):
+            return None
+        # edit_state и user_data — по пользователю, поэтому и очередь по пользователю,
+        # а без пользователя (посты в канале и т.п.) — по чату
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._keys[key]
+
+    def running(self):
+        return self.max_running - self._running._value
+
+    def waiting(self):
+        return sum(count for _, count in self._keys.values()) - self.running()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+update_processor = OrderedUpdateProcessor(CONCURRENT_UPDATES)
+
+
+@gauge("rateguard_updates", "Updates being processed or waiting for their user's turn", ("state",))
+def _updates_in_progress():
+    return {("running",): update_processor.running(), ("waiting",): update_processor.waiting()}
+
+
+def build_application(request=None):
+    """The bot with all handlers and jobs; request replaces the Bot API transport (bench.py)."""
+    builder = (ApplicationBuilder().token(TOKEN).request(request or CountingRequest())
+               .concurrent_updates(update_processor)
+               .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown))
+    if STATE_PATH:
+        builder.persistence(PicklePersistence(
+            STATE_PATH, store_data=PersistenceInput(chat_data=False, callback_data=False),
+            update_interval=STATE_FLUSH_INTERVAL))
+    app = builder.build()
+    persistent = app.persistence is not None
 
     submit_conv = ConversationHandler(
         entry_points=[CommandHandler("submit", submit)],
@@ -690,7 +3479,10 @@ if __name__ == '__main__':
                       CallbackQueryHandler(handle_submit_callback)]
         },
         fallbacks=[],
-        per_chat=True
+        per_chat=True,
+        conversation_timeout=CONVERSATION_TTL,
+        name="submit",
+        persistent=persistent
     )
 
     stats_conv = ConversationHandler(
@@ -699,7 +3491,10 @@ if __name__ == '__main__':
             STATS_SELECT: [CallbackQueryHandler(handle_stats_selection)]
         },
         fallbacks=[],
-        per_chat=True
+        per_chat=True,
+        conversation_timeout=CONVERSATION_TTL,
+        name="stats",
+        persistent=persistent
     )
 
     my_stats_conv = ConversationHandler(
@@ -708,7 +3503,10 @@ if __name__ == '__main__':
             MY_STATS_DAY: [CallbackQueryHandler(handle_my_day_selection)]
         },
         fallbacks=[],
-        per_chat=True
+        per_chat=True,
+        conversation_timeout=CONVERSATION_TTL,
+        name="my_stats",
+        persistent=persistent
     )
 
     app.add_handler(submit_conv)
@@ -716,10 +3514,61 @@ if __name__ == '__main__':
     app.add_handler(my_stats_conv)
     app.add_handler(CommandHandler("broker", broker_lookup))
     app.add_handler(CommandHandler("my_loads", my_loads))
+    app.add_handler(CommandHandler("export", export_loads))
+    app.add_handler(CommandHandler("miles_check", miles_check))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_document))
+    app.add_handler(CommandHandler("import", import_document))
     app.add_handler(CallbackQueryHandler(start_edit_load, pattern="^edit_"))
     app.add_handler(CallbackQueryHandler(handle_edit_field_selection, pattern="^editfield_"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_input))
     app.add_handler(CallbackQueryHandler(cancel_edit, pattern="^cancel_edit$"))
+    app.job_queue.run_once(start_warm_up, 0, name="warm_up")
+    app.job_queue.run_repeating(sync_load_store, interval=LOAD_SYNC_INTERVAL, first=LOAD_SYNC_INTERVAL)
+    app.job_queue.run_repeating(flush_outbox, interval=OUTBOX_FLUSH_INTERVAL, first=0)
+    app.job_queue.run_repeating(expire_conversation_state, interval=600, first=600)
+    if FIRESTORE_MODE != "off" and FIRESTORE_RESYNC_INTERVAL:
+        app.job_queue.run_repeating(firestore_resync, interval=FIRESTORE_RESYNC_INTERVAL,
+                                    first=FIRESTORE_RESYNC_INTERVAL)
+    if FMCSA_SNAPSHOT_URL:
+        app.job_queue.run_repeating(refresh_fmcsa_index, interval=FMCSA_SNAPSHOT_REFRESH,
+                                    first=_fmcsa_index_first_refresh())
+
+    return app
+
+
+def run_webhook(app):
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL")
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
 
-    app.run_polling()
 
+if __name__ == '__main__':
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s", level=logging.INFO)
+    if sys.argv[1:2] == ["import"]:
+        import_cli(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ["firestore-backfill"]:
+        backfill_load_ids()  # строкам без Load ID не под чем лечь в Firestore
+        asyncio.run(firestore_backfill())
+        sys.exit()
+    if sys.argv[1:2] == ["zip-table"]:
+        build_zip_table()
+        sys.exit()
+    if sys.argv[1:2] == ["fmcsa-index"]:
+        update_fmcsa_index(sys.argv[2] if len(sys.argv) > 2 else FMCSA_SNAPSHOT_URL)
+        sys.exit()
+    logger.info("Startup: imports done in %.2fs", time.perf_counter() - _process_started)
+    if METRICS_PORT:
+        start_metrics_server()
+    app = build_application()
+    if BOT_MODE == "webhook":
+        run_webhook(app)
+    else:
+        app.run_polling()